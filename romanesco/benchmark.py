@@ -0,0 +1,209 @@
+""" Micro-benchmarks of the overhead the pipeline framework adds on top of the actual compute:
+settings and fingerprint computation, metadata I/O, cleaning outputs and session discovery.
+
+Tasks are synthetic no-op FileOutputTasks and the session trees are generated, so nothing
+here needs MATLAB, the sima converter or the network. Every operation is measured for each
+size given, to show how it scales, and the results can be compared against a saved baseline.
+
+Usage:
+    python -m evaluation2.benchmark --output results.json
+    python -m evaluation2.benchmark --baseline results.json --tolerance 1.5
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from evaluation2 import data_discovery, trash
+from evaluation2.tasks import FileOutputTask
+
+DEFAULT_SIZES = [1, 4, 16, 64]
+DEFAULT_REPEAT = 20
+# the databases and the trash the benchmark uses, in its work directory
+WORK_DIR_ENV = {"TT_EVALUATION2_TASK_CATALOG": "task_catalog.sqlite",
+                "TT_EVALUATION2_TRASH_DIR": "trash",
+                "TT_EVALUATION2_TRASH_REGISTRY": "trash.sqlite",
+                "TT_EVALUATION2_SESSION_INDEX": "session_index.sqlite",
+                "TT_EVALUATION2_DIGEST_CACHE": "file_digests.sqlite"}
+# settings of the environment that would change what is measured
+UNSET_ENV = ["TT_EVALUATION2_RESULT_STORE_MAX_BYTES", "TT_EVALUATION2_RESULT_STORE",
+             "TT_EVALUATION2_EXPORT_META_FILES", "TT_EVALUATION2_TRASH"]
+
+
+class NoopTask(FileOutputTask):
+    """ Task writing an empty file named after its fingerprint """
+
+    def __init__(self, base_dir, **kwargs):
+        super(NoopTask, self).__init__(**kwargs)
+        self.base_dir = base_dir
+
+    def name(self):
+        return "NoopTask"
+
+    def output(self):
+        return os.path.join(self.base_dir, "noop_" + self.checksum())
+
+    def _run(self):
+        open(self.output(), 'w').close()
+
+
+def build_chain(base_dir, depth):
+    """ depth tasks, each depending on the previous one and adding its own setting """
+    tasks = []
+    for i in range(depth):
+        task = NoopTask(base_dir, **{"setting_{}".format(i): "value_{}".format(i)})
+        if tasks:
+            task.add_previous_task(tasks[-1])
+        tasks.append(task)
+    return tasks
+
+
+def generate_session_tree(base_dir, nb_sessions, sessions_per_experiment=8):
+    """ Creates nb_sessions empty sessions with the layout expected by data_discovery.
+    Returns the session ids """
+    session_ids = []
+    for i in range(nb_sessions):
+        session_id = "session_{:05d}-{:014d}".format(i % 97, i)
+        session_dir = os.path.join(base_dir, "experiment_{}".format(i // sessions_per_experiment), session_id)
+        os.makedirs(session_dir)
+        open(os.path.join(session_dir, session_id + ".bin"), 'w').close()
+        session_ids.append(session_id)
+    return session_ids
+
+
+@contextmanager
+def isolated_environment(work_dir):
+    """ Points the catalog, trash and indexes to the work directory instead of the ones
+    configured in the environment, which is restored afterwards """
+    saved = dict((name, os.environ.get(name)) for name in WORK_DIR_ENV.keys() + UNSET_ENV)
+    for name in UNSET_ENV:
+        os.environ.pop(name, None)
+    for name, fn in WORK_DIR_ENV.iteritems():
+        os.environ[name] = os.path.join(work_dir, fn)
+    try:
+        yield
+    finally:
+        # the reaper reads the registry of the environment
+        trash.wait_for_reaper()
+        for name, value in saved.iteritems():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def measure(func, repeat, setup=None):
+    """ Median seconds of func over repeat runs. setup is called before each run, untimed """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        durations.append(timeit.default_timer() - start)
+    return sorted(durations)[len(durations) // 2]
+
+
+def benchmark_tasks(work_dir, size, repeat):
+    """ Operations on the last task of a chain of the given depth """
+    tasks = build_chain(work_dir, size)
+    last = tasks[-1]
+
+    def invalidate():
+        tasks[0].invalidate_settings()
+
+    def clean_setup():
+        os.makedirs(last.output())
+        for i in range(size):
+            open(os.path.join(last.output(), str(i)), 'w').close()
+
+    last.run()
+    res = {"settings_cold": measure(last.settings, repeat, setup=invalidate),
+           "settings_warm": measure(last.settings, repeat),
+           "checksum_cold": measure(last.checksum, repeat, setup=invalidate),
+           "write_metadata": measure(last.write_metadata, repeat),
+           "is_already_complete": measure(last.is_already_complete, repeat)}
+    last.clean()
+    res["clean_directory"] = measure(last.clean, repeat, setup=clean_setup)
+    return res
+
+
+def benchmark_discovery(work_dir, size, repeat):
+    """ Discovery of 3 sessions among size * 8 sessions, with and without the index """
+    data_dir = os.path.join(work_dir, "data")
+    session_ids = set(generate_session_tree(data_dir, size * 8)[:3])
+    index = data_discovery.SessionIndex(os.path.join(work_dir, "sessions.sqlite"))
+    index.lookup(data_dir, session_ids)
+    return {"discovery_walk": measure(lambda: data_discovery.get_all_session_input_data(
+                data_dir, session_ids, use_index=False), repeat),
+            "discovery_index": measure(lambda: index.lookup(data_dir, session_ids), repeat)}
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT):
+    """ Returns {operation: {size: median seconds}} """
+    results = {}
+    for size in sizes:
+        work_dir = tempfile.mkdtemp(prefix="evaluation2_benchmark_")
+        try:
+            with isolated_environment(work_dir):
+                timings = benchmark_tasks(work_dir, size, repeat)
+                timings.update(benchmark_discovery(work_dir, size, repeat))
+        finally:
+            shutil.rmtree(work_dir)
+        for operation, seconds in timings.iteritems():
+            results.setdefault(operation, {})[str(size)] = seconds
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """ Returns a list of (operation, size, baseline seconds, seconds) slower than tolerance times the baseline """
+    regressions = []
+    for operation, timings in sorted(results.iteritems()):
+        for size, seconds in sorted(timings.iteritems(), key=lambda item: int(item[0])):
+            reference = baseline.get(operation, {}).get(size)
+            if reference and seconds > reference * tolerance:
+                regressions.append((operation, size, reference, seconds))
+    return regressions
+
+
+def print_results(results):
+    sizes = sorted(set(size for timings in results.itervalues() for size in timings), key=int)
+    print "{:<22}".format("operation \\ size") + "".join("{:>12}".format(size) for size in sizes)
+    for operation, timings in sorted(results.iteritems()):
+        print "{:<22}".format(operation) + "".join(
+            "{:>10.1f}us".format(timings[size] * 1e6) if size in timings else "{:>12}".format("-") for size in sizes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of the pipeline framework")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="chain depths, and sessions in multiples of 8 for the discovery")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file of results to compare to")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="fail if an operation is slower than tolerance times the baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sizes=args.sizes, repeat=args.repeat)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for operation, size, reference, seconds in regressions:
+            print "Regression: {} (size {}) took {:.1f}us, baseline {:.1f}us".format(
+                operation, size, seconds * 1e6, reference * 1e6)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,8 @@ CELERY_TASK_SERIALIZER='pickle'
 CELERY_ACCEPT_CONTENT=['json','yaml', 'pickle']
 CELERY_TASK_RESULT_EXPIRES=None
 CELERY_RESULT_SERIALIZER='pickle'
+# a queue per worker, to send tasks to the worker holding local state (see pipeline2.release_outputs)
+CELERY_WORKER_DIRECT = True
 CELERY_IMPORTS=("evaluation2.pipeline2","evaluation2.report_gen_run", "evaluation.evaluate_ground_truth")
 
 BROKER_TRANSPORT = "amqp"
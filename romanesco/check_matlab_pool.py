@@ -0,0 +1,80 @@
+""" Checks the MATLAB pool (see matlab_pool) against the fake MATLAB of fake_matlab.py: workers
+are reused, recycled, kept per code directory, discarded on failure and stopped on close.
+
+Usage:
+    python -m evaluation2.check_matlab_pool
+"""
+import errno
+import os
+import re
+import sys
+from StringIO import StringIO
+
+from evaluation2.matlab_pool import MatlabPool, MatlabJobFailed
+
+FAKE_MATLAB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_matlab.py")
+# printed by the fake MATLAB for every job it runs
+FAKE_JOB_RE = re.compile(r"^pid (\d+) job (\d+):", re.MULTILINE)
+MATLAB_HOME = "/matlab"
+STARTUP = "addpath('/gtsam');"
+
+
+def run_job(pool, function, code_directory, startup_commands=STARTUP):
+    """ Runs a job on the pool and returns the pid of the fake MATLAB that ran it """
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        pool.run(function, code_directory, [], MATLAB_HOME, startup_commands=startup_commands)
+    finally:
+        sys.stdout = stdout
+    return int(FAKE_JOB_RE.findall(output.getvalue())[-1][0])
+
+
+def expect_failure(pool, function, code_directory, startup_commands=STARTUP):
+    try:
+        run_job(pool, function, code_directory, startup_commands=startup_commands)
+    except MatlabJobFailed:
+        return
+    raise AssertionError("{} didn't raise MatlabJobFailed".format(function))
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def check_pool():
+    """ Raises AssertionError if the pool doesn't behave as expected """
+    pool = MatlabPool(2, max_jobs_per_worker=2, command="{} {}".format(sys.executable, FAKE_MATLAB))
+    pids = set()
+    try:
+        first = run_job(pool, "main", "/code/a")
+        assert run_job(pool, "main", "/code/a") == first, "worker not reused"
+        second = run_job(pool, "main", "/code/a")
+        assert second != first, "worker not recycled after max_jobs_per_worker jobs"
+
+        other = run_job(pool, "main", "/code/b")
+        assert other not in (first, second), "code directories share a worker"
+        assert run_job(pool, "main", "/code/a") == second, "idle worker of another code directory stopped"
+        pids.update([first, second, other])
+
+        for function in ["fail", "crash"]:
+            expect_failure(pool, function, "/code/a")
+            pid = run_job(pool, "main", "/code/a")
+            assert pid not in pids, "worker kept after {}".format(function)
+            pids.add(pid)
+
+        expect_failure(pool, "main", "/code/c", startup_commands="fail();")
+        pids.add(run_job(pool, "main", "/code/a"))
+    finally:
+        pool.close()
+    running = [pid for pid in pids if is_running(pid)]
+    assert not running, "workers {} left after close".format(running)
+
+
+if __name__ == "__main__":
+    check_pool()
+    print "MATLAB pool check passed"
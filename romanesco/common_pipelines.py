@@ -8,7 +8,11 @@ from tt_backend.utils import Fn
 from evaluation2.download_tasks import DownloadCalibrationValues
 from evaluation2.sima_task import SimaConvertBin
 from evaluation2.matlab_tasks import ImuPreprocess, FuseKnowtion
-from evaluation2.github_tasks import CheckoutTTRepoFromWeb
+from evaluation2.github_tasks import CheckoutTTRepoFromWeb, get_commit_hash_resolver
+
+IMU_PP_REPO = "tt-pl-imu_preprocessor"
+FA_REPO = "tracktics-knowtion"
+GTSAM_REPO = "tt-pl-gtsam-knowtion"
 
 
 def create_sima_imu_fa_pipeline(base_dir, tracker_id, input_bin=None, prev_task=None,
@@ -29,10 +33,9 @@ def create_sima_imu_fa_pipeline(base_dir, tracker_id, input_bin=None, prev_task=
     code_base_dir = base_dir
     task3b = DownloadCalibrationValues(tracker_id=tracker_id, base_dir=base_dir, use_calibration_before=calibration_dt)
     imu_pp_expected = repo_tasks["imu"].output()
-    calib_json_expected = task3b.output()
-    # imu preprocessor
+    # imu preprocessor. The calibration json path is only known once the calibration date is looked up
     task3 = ImuPreprocess(imu_pp_code_directory=imu_pp_expected,
-                          calibration_json=calib_json_expected,
+                          calibration_json=task3b,
                           matlab_installed=have_matlab_license, sima_dir=task2.output())
     task3.add_previous_task(task2)
     task3.add_previous_task(repo_tasks["imu"])
@@ -40,7 +43,7 @@ def create_sima_imu_fa_pipeline(base_dir, tracker_id, input_bin=None, prev_task=
     # fa
     fa_knowtion_expected = repo_tasks["fa"].output()
     task4 = FuseKnowtion(fa_knowtion_code_directory=fa_knowtion_expected, gtsam_dir=repo_tasks["gtsam"].output(), 
-                         matlab_installed=have_matlab_license, sima_dir=task3.output())
+                         matlab_installed=have_matlab_license, sima_dir=task3)
     task4.add_previous_task(repo_tasks["fa"])
     task4.add_previous_task(repo_tasks["gtsam"])
     task4.add_previous_task(task3)
@@ -56,8 +59,13 @@ def create_repos_pipeline(base_dir, fa_hash="latest", gtsam_hash="latest"):
     """
 
     code_base_dir = base_dir
-    task3a = CheckoutTTRepoFromWeb(repo="tt-pl-imu_preprocessor", commit_hash="latest_compiled",
+    hashes = get_commit_hash_resolver().resolve_all(get_repo_commit_hashes(fa_hash=fa_hash, gtsam_hash=gtsam_hash))
+    task3a = CheckoutTTRepoFromWeb(repo=IMU_PP_REPO, commit_hash=hashes[(IMU_PP_REPO, "latest_compiled")],
                                    base_dir=code_base_dir,)
-    task4a = CheckoutTTRepoFromWeb(repo="tracktics-knowtion", commit_hash=fa_hash, base_dir=code_base_dir)
-    task4b = CheckoutTTRepoFromWeb(repo="tt-pl-gtsam-knowtion", commit_hash=gtsam_hash, base_dir=code_base_dir)
+    task4a = CheckoutTTRepoFromWeb(repo=FA_REPO, commit_hash=hashes[(FA_REPO, fa_hash)], base_dir=code_base_dir)
+    task4b = CheckoutTTRepoFromWeb(repo=GTSAM_REPO, commit_hash=hashes[(GTSAM_REPO, gtsam_hash)], base_dir=code_base_dir)
     return {"imu": task3a, "fa": task4a, "gtsam":task4b} 
+
+def get_repo_commit_hashes(fa_hash="latest", gtsam_hash="latest"):
+    """ The (repo, commit hash) pairs checked out by create_repos_pipeline """
+    return [(IMU_PP_REPO, "latest_compiled"), (FA_REPO, fa_hash), (GTSAM_REPO, gtsam_hash)]
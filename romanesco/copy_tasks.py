@@ -1,13 +1,15 @@
 import os
 
-from tt_backend.utils import Files, filenames
+from tt_backend.utils import filenames
 
-from tasks import FileOutputTask
+from tasks import FileOutputTask, output_of
+import staging
 from formatting import red, green, orange
 
 
 class SymlinkGroundTruth(FileOutputTask):
-    """Symlinks any ground truth files found in a directory to another directory with the same names"""
+    """Adds any ground truth files found in a directory to the stage manifest of another directory
+    (or the output directory of a task), see staging"""
 
     def __init__(self, in_dir, out_dir, **kwargs):
 
@@ -22,9 +24,9 @@ class SymlinkGroundTruth(FileOutputTask):
 
     def output(self):
         # Creates an empty file to signify success
-        return os.path.join(self.out_dir, "GROUND_TRUTH_SYMLINK_SUCCESS")
+        return os.path.join(output_of(self.out_dir), "GROUND_TRUTH_SYMLINK_SUCCESS")
 
     def _run(self):
-        Files.symlink_everything(self.in_dir, self.out_dir, filenames_to_skip=set(filenames.IMU_PP_FNS+
-                                                                                  filenames.SIMA_FNS))
+        staging.add_source(output_of(self.out_dir), self.in_dir, filenames_to_skip=set(filenames.IMU_PP_FNS+
+                                                                                 filenames.SIMA_FNS))
         open(self.output(), 'a').close()
@@ -1,8 +1,120 @@
+from contextlib import closing
 import os
+import time
 
-from tt_backend.utils import Fn
+from tt_backend.utils import Fn, env
 
-def get_all_session_input_data(base_folder, session_ids_to_match=None):
+from evaluation2 import local_db
+
+# seconds during which the session index is used without checking the file system for changes
+SESSION_INDEX_REFRESH_INTERVAL = 60
+# sqlite limits the number of parameters of a query
+MAX_QUERY_PARAMETERS = 500
+
+SESSION_INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS experiments (
+       directory TEXT PRIMARY KEY, base_folder TEXT, mtime REAL)""",
+    """CREATE TABLE IF NOT EXISTS sessions (
+       session_id TEXT, experiment TEXT, bin_path TEXT, sima_dir TEXT, tracker_id TEXT, size INTEGER, mtime REAL,
+       PRIMARY KEY (experiment, session_id))""",
+    "CREATE INDEX IF NOT EXISTS sessions_session_id ON sessions (session_id)",
+    "CREATE TABLE IF NOT EXISTS refreshes (base_folder TEXT PRIMARY KEY, refreshed_at REAL)",
+]
+
+
+def _session_entries(experiment_dir):
+    """ Scans an experiment directory and returns a tuple
+    (session_id, bin_path, sima_dir, tracker_id, size, mtime) per session """
+    res = []
+    for sima_directory in Fn.getChildrenDirectories(experiment_dir):
+        _, session_id,_ = Fn.fileparts(sima_directory)
+        tracker_id = session_id[8:13]
+        bin_path = os.path.join(sima_directory, session_id+".bin")
+        if os.path.exists(bin_path):
+            st = os.stat(bin_path)
+            size, mtime = st.st_size, st.st_mtime
+        else:
+            size, mtime = None, None
+        res.append((session_id, bin_path, sima_directory, tracker_id, size, mtime))
+    return res
+
+
+class SessionIndex(object):
+    """ On-disk index of the sessions stored under base folders (see get_all_session_input_data
+    for the layout). It is refreshed incrementally: only the experiment directories whose
+    modification time changed are scanned again. Lookups don't touch the file system if the
+    index was refreshed less than refresh_interval seconds ago.
+    """
+
+    def __init__(self, index_file, refresh_interval=SESSION_INDEX_REFRESH_INTERVAL):
+        self.index_file = index_file
+        self.refresh_interval = refresh_interval
+
+    def _connect(self):
+        return closing(local_db.connect(self.index_file, SESSION_INDEX_SCHEMA))
+
+    def refresh(self, base_folder):
+        experiment_dirs = Fn.getChildrenDirectories(base_folder)
+        with self._connect() as conn:
+            known = dict(conn.execute("SELECT directory, mtime FROM experiments WHERE base_folder=?", (base_folder,)))
+            for directory in set(known) - set(experiment_dirs):
+                conn.execute("DELETE FROM sessions WHERE experiment=?", (directory,))
+                conn.execute("DELETE FROM experiments WHERE directory=?", (directory,))
+            for directory in experiment_dirs:
+                mtime = os.stat(directory).st_mtime
+                if known.get(directory) == mtime:
+                    continue
+                conn.execute("DELETE FROM sessions WHERE experiment=?", (directory,))
+                conn.executemany("""INSERT INTO sessions (session_id, experiment, bin_path, sima_dir, tracker_id, size, mtime)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                 [(entry[0], directory) + entry[1:] for entry in _session_entries(directory)])
+                conn.execute("INSERT OR REPLACE INTO experiments (directory, base_folder, mtime) VALUES (?, ?, ?)",
+                             (directory, base_folder, mtime))
+            conn.execute("INSERT OR REPLACE INTO refreshes (base_folder, refreshed_at) VALUES (?, ?)",
+                         (base_folder, time.time()))
+            conn.commit()
+
+    def refresh_if_needed(self, base_folder):
+        """ Returns True if the index was refreshed """
+        with self._connect() as conn:
+            row = conn.execute("SELECT refreshed_at FROM refreshes WHERE base_folder=?", (base_folder,)).fetchone()
+        if row is None or time.time() - row[0] > self.refresh_interval:
+            self.refresh(base_folder)
+            return True
+        return False
+
+    def _query(self, base_folder, session_ids_to_match):
+        query = """SELECT s.session_id, s.bin_path, s.sima_dir, s.tracker_id FROM sessions s
+                   JOIN experiments e ON s.experiment = e.directory WHERE e.base_folder=?"""
+        order = " ORDER BY s.sima_dir"
+        with self._connect() as conn:
+            if session_ids_to_match is None:
+                return conn.execute(query + order, (base_folder,)).fetchall()
+            session_ids = sorted(session_ids_to_match)
+            rows = []
+            for i in range(0, len(session_ids), MAX_QUERY_PARAMETERS):
+                chunk = session_ids[i:i+MAX_QUERY_PARAMETERS]
+                rows.extend(conn.execute(query + " AND s.session_id IN ({})".format(",".join("?" * len(chunk))) + order,
+                                         [base_folder] + chunk).fetchall())
+        rows.sort(key=lambda row: row[2])
+        return rows
+
+    def lookup(self, base_folder, session_ids_to_match=None):
+        """ Same as get_all_session_input_data, from the index. Sessions asked for that are not
+        in the index may have been added since the last refresh, the index is then refreshed """
+        refreshed = self.refresh_if_needed(base_folder)
+        rows = self._query(base_folder, session_ids_to_match)
+        if not refreshed and session_ids_to_match is not None \
+                and not set(session_ids_to_match) <= set(row[0] for row in rows):
+            self.refresh(base_folder)
+            rows = self._query(base_folder, session_ids_to_match)
+        return [(str(bin_path), str(sima_dir), str(tracker_id)) for _, bin_path, sima_dir, tracker_id in rows]
+
+def get_session_index_file():
+    return env.get_env_value("TT_EVALUATION2_SESSION_INDEX", optional=True)
+
+
+def get_all_session_input_data(base_folder, session_ids_to_match=None, index_file=None, use_index=True):
     """" Returns all the session data stored in the filesystem that matches a set of session ids.
 
 
@@ -15,7 +127,14 @@ def get_all_session_input_data(base_folder, session_ids_to_match=None):
     [(base_folder/subfolder1/session_fUqpW-00dgEKsvWZ/session_fUqpW-00dgEKsvWZ.bin, base_folder/subfolder1/session_fUqpW-00dgEKsvWZ, fUqpW),
     (base_folder/subfolder1/session_fUqpW-01dgEKsvWZ/session_fUqpW-00dgEKsvWZ.bin, base_folder/subfolder1/session_fUqpW-01dgEKsvWZ, fUqpW),
     (base_folder/subfolder2/session_UBPup-01UX7BloPS/session_UBPup-01UX7BloPS.bin, base_folder/subfolder2/session_UBPup-01UX7BloPS/, UBPup)] 
+
+    If an index file is given (by default TT_EVALUATION2_SESSION_INDEX), the sessions are looked up
+    in a SessionIndex instead of walking the whole base folder. With use_index=False the base
+    folder is always walked.
     """
+    index_file = (index_file or get_session_index_file()) if use_index else None
+    if index_file:
+        return SessionIndex(index_file).lookup(base_folder, session_ids_to_match)
 
     res = []
     experiment_dirs = Fn.getChildrenDirectories(base_folder)
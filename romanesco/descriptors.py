@@ -0,0 +1,163 @@
+""" Compact, versioned descriptions of single session pipelines.
+
+Instead of pickling the pipeline objects (with every task and all the upstream tasks they
+reference) into the broker messages, the sessions are sent as a descriptor: the pipeline
+and task classes, their attributes and the dependency edges between the tasks. Workers
+rebuild the pipeline locally from it, without calling the constructors (so without doing
+again any lookups done at construction time). Everything in a descriptor can be
+serialized as JSON.
+
+The chord callback of a MultiSessionPipeline gets a descriptor too, with the attributes of
+the multi session pipeline but not the session pipelines it contains (see
+multi_session_pipeline_to_descriptor).
+
+Example of a descriptor:
+    {"version": 1,
+     "pipeline": {"class": "evaluation2.full_report_gen_pipeline.EndToEndFa", "attributes": {...}},
+     "tasks": [{"class": "evaluation2.sima_task.SimaConvertBin", "attributes": {...}}, ...],
+     "edges": [[2, 0], [2, 1]], # task 2 depends on tasks 0 and 1
+     "tasklist": [0, 1, 2]}
+"""
+from datetime import datetime
+import importlib
+
+from evaluation2.tasks import Task
+
+DESCRIPTOR_VERSION = 1
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# attributes that are rebuilt rather than described
+TASK_ATTRIBUTES_NOT_DESCRIBED = set(["_prev_tasks", "_next_tasks", "_settings_cache", "_fingerprint_cache"])
+PIPELINE_ATTRIBUTES_NOT_DESCRIBED = set(["tasks", "exec_stats", "last_output", "_complete_tasks", "process_resources"])
+
+
+def _class_path(obj):
+    return "{}.{}".format(type(obj).__module__, type(obj).__name__)
+
+
+def _load_class(class_path):
+    module_name, class_name = class_path.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class _Encoder(object):
+    """ Encodes attribute values, numbering the tasks found along the way """
+
+    def __init__(self):
+        self.tasks = []
+        self.task_indices = {}
+
+    def task_index(self, task):
+        if task not in self.task_indices:
+            self.task_indices[task] = len(self.tasks)
+            self.tasks.append(task)
+        return self.task_indices[task]
+
+    def encode(self, value):
+        if isinstance(value, Task):
+            return {"__task__": self.task_index(value)}
+        if isinstance(value, datetime):
+            return {"__datetime__": value.strftime(DATETIME_FORMAT)}
+        if isinstance(value, (set, frozenset)):
+            return {"__set__": [self.encode(v) for v in value]}
+        if isinstance(value, dict):
+            return dict((k, self.encode(v)) for k, v in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            return [self.encode(v) for v in value]
+        if value is None or isinstance(value, (basestring, bool, int, long, float)):
+            return value
+        raise Exception("Can't describe value {} of type {}".format(value, type(value)))
+
+    def encode_attributes(self, obj, excluded):
+        return dict((k, self.encode(v)) for k, v in obj.__dict__.iteritems() if k not in excluded)
+
+
+def _decode(value, tasks):
+    if isinstance(value, dict):
+        if "__task__" in value:
+            return tasks[value["__task__"]]
+        if "__datetime__" in value:
+            return datetime.strptime(value["__datetime__"], DATETIME_FORMAT)
+        if "__set__" in value:
+            return set(_decode(v, tasks) for v in value["__set__"])
+        return dict((k, _decode(v, tasks)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_decode(v, tasks) for v in value]
+    return value
+
+
+def pipeline_to_descriptor(pipeline):
+    """ Describes a SingleSessionPipeline, its tasks and all the tasks they depend on """
+    encoder = _Encoder()
+    tasklist = [encoder.task_index(task) for task in pipeline.tasklist()]
+    pipeline_attributes = encoder.encode_attributes(pipeline, PIPELINE_ATTRIBUTES_NOT_DESCRIBED)
+    task_descriptors = []
+    edges = []
+    # the list of tasks grows while describing them, as upstream tasks are found
+    i = 0
+    while i < len(encoder.tasks):
+        task = encoder.tasks[i]
+        task_descriptors.append({"class": _class_path(task),
+                                 "attributes": encoder.encode_attributes(task, TASK_ATTRIBUTES_NOT_DESCRIBED)})
+        edges.extend([i, encoder.task_index(prev)] for prev in task.prev_tasks())
+        i += 1
+    return {"version": DESCRIPTOR_VERSION,
+            "pipeline": {"class": _class_path(pipeline), "attributes": pipeline_attributes},
+            "tasks": task_descriptors,
+            "edges": edges,
+            "tasklist": tasklist}
+
+
+def _check_version(descriptor):
+    if descriptor.get("version") != DESCRIPTOR_VERSION:
+        raise Exception("Unsupported pipeline descriptor version {} (expected {})".format(
+            descriptor.get("version"), DESCRIPTOR_VERSION))
+
+
+def pipeline_from_descriptor(descriptor):
+    """ Rebuilds the pipeline described by pipeline_to_descriptor """
+    _check_version(descriptor)
+    tasks = []
+    for task_descriptor in descriptor["tasks"]:
+        cls = _load_class(task_descriptor["class"])
+        tasks.append(cls.__new__(cls))
+    for task, task_descriptor in zip(tasks, descriptor["tasks"]):
+        state = _decode(task_descriptor["attributes"], tasks)
+        state["_prev_tasks"] = []
+        state["_settings_cache"] = None
+        state["_fingerprint_cache"] = None
+        task.__setstate__(state)
+    for task_idx, prev_idx in descriptor["edges"]:
+        tasks[task_idx]._prev_tasks.append(tasks[prev_idx])
+
+    cls = _load_class(descriptor["pipeline"]["class"])
+    pipeline = cls.__new__(cls)
+    pipeline.__dict__.update(_decode(descriptor["pipeline"]["attributes"], tasks))
+    pipeline.tasks = [tasks[idx] for idx in descriptor["tasklist"]]
+    pipeline.exec_stats = []
+    pipeline.last_output = None
+    pipeline._complete_tasks = set()
+    pipeline.process_resources = None
+    return pipeline
+
+
+def multi_session_pipeline_to_descriptor(pipeline, excluded):
+    """ Describes a MultiSessionPipeline without the attributes in excluded, which must
+    include all the attributes referencing tasks """
+    encoder = _Encoder()
+    attributes = encoder.encode_attributes(pipeline, excluded)
+    if encoder.tasks:
+        raise Exception("Can't describe the tasks of {}, their attributes should be excluded".format(
+            _class_path(pipeline)))
+    return {"version": DESCRIPTOR_VERSION,
+            "pipeline": {"class": _class_path(pipeline), "attributes": attributes}}
+
+
+def multi_session_pipeline_from_descriptor(descriptor):
+    """ Rebuilds the pipeline described by multi_session_pipeline_to_descriptor, without the
+    excluded attributes """
+    _check_version(descriptor)
+    cls = _load_class(descriptor["pipeline"]["class"])
+    pipeline = cls.__new__(cls)
+    pipeline.__dict__.update(_decode(descriptor["pipeline"]["attributes"], []))
+    return pipeline
@@ -4,29 +4,96 @@ from tt_api import calibration as tt_cal
 from tt_backend.utils import setup_json_calib_file
 
 from tasks import FileOutputTask
+from lookup_cache import TTLCache, map_concurrently
 import formatting
 
+# seconds during which calibration lookups are reused
+CALIBRATION_CACHE_TTL = 600
+CALIBRATION_SENSORS = ["acc", "gyr", "mag"]
+
+
+class CalibrationResolver(object):
+    """ Memoizes the calls to the calibration service by (tracker, cutoff date), and
+    batches the lookups of many trackers so that they're done concurrently """
+
+    def __init__(self, ttl=CALIBRATION_CACHE_TTL):
+        self._latest_dates = TTLCache(ttl)
+        self._calibrations = TTLCache(ttl)
+
+    def latest_calibration_date(self, tracker_id, use_calibration_before=None):
+        def lookup():
+            print formatting.green("Getting latest calibration date for {}. If this hangs, check that calibration.tracktics.zone:5000/cal is responding, restart may be required.".format(tracker_id))
+            return tt_cal.get_latest_datetime_with_calibration_for_tracker(tracker_id, dt=use_calibration_before)
+        return self._latest_dates.get((tracker_id, use_calibration_before), lookup)
+
+    def prefetch_latest_calibration_dates(self, tracker_ids, use_calibration_before=None):
+        map_concurrently(lambda tracker_id: self.latest_calibration_date(tracker_id, use_calibration_before),
+                         sorted(set(tracker_ids)))
+
+    def calibration(self, tracker_id, sensor, calibration_date):
+        return self._calibrations.get((tracker_id, sensor, calibration_date),
+                lambda: tt_cal.get_calibration(tracker_id, sensor, datetime=calibration_date, as_dict=True))
+
+    def calibrations(self, tracker_id, calibration_date, sensors=CALIBRATION_SENSORS):
+        """ Returns the calibration of each sensor, looked up concurrently """
+        return map_concurrently(lambda sensor: self.calibration(tracker_id, sensor, calibration_date), sensors)
+
+
+_calibration_resolver = CalibrationResolver()
+
+
+def get_calibration_resolver():
+    """ The resolver shared by all the tasks of the process """
+    return _calibration_resolver
+
+
+def resolve_calibration_dates(tasks):
+    """ Resolves the calibration dates of all the DownloadCalibrationValues tasks given,
+    looking up the different trackers concurrently """
+    calibration_tasks = [task for task in tasks if isinstance(task, DownloadCalibrationValues)]
+    cutoffs = set(task.use_calibration_before for task in calibration_tasks)
+    for cutoff in cutoffs:
+        get_calibration_resolver().prefetch_latest_calibration_dates(
+            [task.tracker_id for task in calibration_tasks if task.use_calibration_before == cutoff], cutoff)
+    for task in calibration_tasks:
+        task.resolve_calibration_date()
+
+
 class DownloadCalibrationValues(FileOutputTask):
+    """ The calibration date is only looked up when the settings or the output are first needed,
+    so that creating the task doesn't block on the calibration service """
 
     def __init__(self, base_dir="", tracker_id="", use_calibration_before=None, **kwargs):
         super(DownloadCalibrationValues, self).__init__(**kwargs)
         self.base_dir = base_dir
-        print formatting.green("Getting latest calibration date as part of initialization. If this hangs, check that calibration.tracktics.zone:5000/cal is responding, restart may be required.")
-        self.latest_date_of_calibration_values = tt_cal.get_latest_datetime_with_calibration_for_tracker(tracker_id,
-                dt=use_calibration_before)
-        print formatting.green("Got latest date: {}".format(self.latest_date_of_calibration_values))
+        self.use_calibration_before = use_calibration_before
+        self.latest_date_of_calibration_values = None
         self.tracker_id = tracker_id
-        self.update_settings("calibration_max_date", self.latest_date_of_calibration_values.strftime(formatting.YYYYMMDDHHMMSS))
         self.update_settings("tracker_id", self.tracker_id)
 
+    def resolve_calibration_date(self):
+        if self.latest_date_of_calibration_values is None:
+            self.latest_date_of_calibration_values = get_calibration_resolver().latest_calibration_date(
+                    self.tracker_id, self.use_calibration_before)
+            print formatting.green("Got latest date: {}".format(self.latest_date_of_calibration_values))
+            self.update_settings("calibration_max_date", self.latest_date_of_calibration_values.strftime(formatting.YYYYMMDDHHMMSS))
+        return self.latest_date_of_calibration_values
+
+    def settings(self):
+        self.resolve_calibration_date()
+        return super(DownloadCalibrationValues, self).settings()
+
+    def fingerprint(self):
+        self.resolve_calibration_date()
+        return super(DownloadCalibrationValues, self).fingerprint()
+
     def name(self):
         return "DownloadCalibrationValues"
 
     def _run(self):
         tracker_id = self.tracker_id
-        acc_calib = tt_cal.get_calibration(tracker_id, "acc", datetime=self.latest_date_of_calibration_values, as_dict=True)
-        gyr_calib = tt_cal.get_calibration(tracker_id, "gyr", datetime=self.latest_date_of_calibration_values, as_dict=True)
-        mag_calib = tt_cal.get_calibration(tracker_id, "mag", datetime=self.latest_date_of_calibration_values, as_dict=True)
+        acc_calib, gyr_calib, mag_calib = get_calibration_resolver().calibrations(tracker_id,
+                self.resolve_calibration_date())
         calibration_dict = setup_json_calib_file.get_default_calibration()
         setup_json_calib_file.perturb_calibration(calibration_dict, **acc_calib)
         setup_json_calib_file.perturb_calibration(calibration_dict, **gyr_calib)
@@ -37,5 +104,4 @@ class DownloadCalibrationValues(FileOutputTask):
     def output(self):
         return os.path.join(self.base_dir,
                 "calibration_{}_{}.json".format(self.tracker_id,
-                    self.latest_date_of_calibration_values.strftime(formatting.YYYYMMDDHHMMSS)))
-
+                    self.resolve_calibration_date().strftime(formatting.YYYYMMDDHHMMSS)))
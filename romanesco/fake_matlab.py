@@ -0,0 +1,42 @@
+""" A fake MATLAB speaking the protocol of matlab_pool, to try the pool without MATLAB:
+
+    TT_EVALUATION2_MATLAB_COMMAND="python /path/to/fake_matlab.py" TT_EVALUATION2_MATLAB_POOL_SIZE=2 ...
+
+It prints the statements it receives instead of running them. Calling a function named
+"fail" reports a MATLAB error and calling one named "crash" makes the process exit.
+"""
+import os
+import re
+import sys
+
+JOB_RE = re.compile(r"^try, (.*) disp\(\['(\w+)' '(\w+)_OK'\]\);")
+FUNCTION_RE = re.compile(r"(\w+)\(")
+CRASH_EXIT_CODE = 3
+
+
+def main():
+    jobs = 0
+    while True:
+        line = sys.stdin.readline()
+        if not line or line.strip() == "exit":
+            return 0
+        match = JOB_RE.match(line)
+        if match is None:
+            print "Unexpected input: {}".format(line.strip())
+            sys.stdout.flush()
+            continue
+        statements, marker, job_id = match.groups()
+        functions = FUNCTION_RE.findall(statements)
+        if "crash" in functions:
+            return CRASH_EXIT_CODE
+        jobs += 1
+        print "pid {} job {}: {}".format(os.getpid(), jobs, statements)
+        if "fail" in functions:
+            print ">> {}{}_FAILED Undefined function 'fail'".format(marker, job_id)
+        else:
+            print ">> {}{}_OK".format(marker, job_id)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+""" Fingerprints of input files based on their content. The digests are cached
+persistently and keyed on (device, inode, size, mtime), so that big files are only
+hashed again when they change """
+from contextlib import closing
+import hashlib
+import os
+
+from tt_backend.utils import env
+
+from evaluation2 import local_db
+
+DEFAULT_DIGEST_CACHE_FILE = "/tmp/evaluation2_file_digests.sqlite"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS digests (
+             device INTEGER, inode INTEGER, size INTEGER, mtime REAL, digest TEXT,
+             PRIMARY KEY (device, inode))"""]
+
+
+def get_digest_cache_file():
+    cache_file = env.get_env_value("TT_EVALUATION2_DIGEST_CACHE", optional=True)
+    return cache_file or DEFAULT_DIGEST_CACHE_FILE
+
+
+def compute_file_digest(fn):
+    """ Returns the sha256 of the content of the file, without using the cache """
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_digest(fn, cache_file=None):
+    """ Returns the sha256 of the content of the file. The file is only read if it is
+    not in the cache or its size or modification time changed since it was hashed.
+
+    Args:
+        fn: the file to fingerprint
+        cache_file: Optional, the sqlite file of the cache. By default the value of
+            TT_EVALUATION2_DIGEST_CACHE or /tmp/evaluation2_file_digests.sqlite
+    """
+    cache_file = cache_file or get_digest_cache_file()
+    st = os.stat(fn)
+    with closing(local_db.connect(cache_file, SCHEMA)) as conn:
+        row = conn.execute("SELECT size, mtime, digest FROM digests WHERE device=? AND inode=?",
+                           (st.st_dev, st.st_ino)).fetchone()
+    if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+        return str(row[2])
+
+    digest = compute_file_digest(fn)
+    st_after = os.stat(fn)
+    if (st_after.st_size, st_after.st_mtime) != (st.st_size, st.st_mtime):
+        # the file changed while it was being read, don't cache a digest of a partial write
+        return digest
+    with closing(local_db.connect(cache_file, SCHEMA)) as conn:
+        conn.execute("INSERT OR REPLACE INTO digests (device, inode, size, mtime, digest) VALUES (?, ?, ?, ?, ?)",
+                     (st.st_dev, st.st_ino, st.st_size, st.st_mtime, digest))
+        conn.commit()
+    return digest
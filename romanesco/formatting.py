@@ -5,42 +5,145 @@ def format_metadata_as_markdown(json_file, title="Metadata"):
     with open(json_file,'r') as f:
         json_str = f.read()
 
-    d = json.loads(json_str)
+    return format_settings_as_markdown(json.loads(json_str), title=title)
+
+def format_settings_as_markdown(d, title="Metadata"):
     s = "### {} ### \n".format(title)
     for key, value in d.iteritems():
         s+="* **{}**: {} \n".format(key, value)
     return s
 
-def get_markdown_from_statistics_files(statistics_files):
-    s = "### Time Statistics for this run ### \n"
+def format_seconds(secs):
+    if secs<60:
+        return "{:.1f} seconds".format(secs)
+    return "{} minutes {:.1f} seconds".format(int(secs//60), secs%60)
+
+
+def percentile(sorted_values, q):
+    """ q-th percentile (0-100) of sorted values, interpolating linearly between the closest ranks """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100.
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def _summarize(durations, nb_slowest):
+    """ durations is a list of (session output, seconds) """
+    seconds = sorted(secs for _, secs in durations)
+    total = sum(seconds)
+    slowest = sorted(durations, key=lambda d: d[1], reverse=True)[:nb_slowest]
+    return {"count": len(seconds), "total_seconds": total, "mean_seconds": float(total) / len(seconds),
+            "p50_seconds": percentile(seconds, 50), "p95_seconds": percentile(seconds, 95),
+            "max_seconds": seconds[-1],
+            "slowest": [{"output": output, "seconds_elapsed": secs} for output, secs in slowest]}
 
+
+def aggregate_statistics(statistics_files, nb_slowest=3):
+    """ Aggregates the statistics files of many sessions (see SingleSessionPipeline.write_statistics)
+
+    Returns:
+        dict: with the number of sessions, and for each stage (task name, in order of first appearance)
+        and for the whole session: count, total, mean, p50, p95 and max seconds and the slowest sessions.
+        The stages also have the subprocesses they started and the cpu seconds of the MATLAB pool
+        they used. The process-wide cpu seconds and peak rss of the session runs, which include
+        whatever else ran in the same process, are summarized separately (see resource_usage)
+    """
+    stage_durations = {}
+    stage_resources = {}
+    stage_order = []
+    session_durations = []
+    process_cpu = []
+    process_max_rss_kb = []
     for json_file in statistics_files:
         with open(json_file, 'r') as f:
-            json_str = f.read()
-
-        d = json.loads(json_str)
-        stats = d["statistics"]
+            d = json.load(f)
         output = d["output"]
-        total_secs = 0
-        s+="* Task with output {}\n".format(output)
-        for entry in stats:
+        if d.get("process_resources"):
+            process_cpu.append((output, _process_cpu_seconds(d["process_resources"])))
+            process_max_rss_kb.append(_process_max_rss_kb(d["process_resources"]))
+        session_total = 0
+        for entry in d["statistics"]:
             task_name = entry["task_name"]
-            secs = entry["seconds_elapsed"]
-            total_secs+=secs
-            if secs<60:
-                time_str = "{} seconds".format(secs)
-            else:
-                time_str = "{} minutes {} seconds".format(secs/60, secs%60)
-            s+= " * **{}**: {}\n ".format(task_name, time_str)
-        if total_secs<60:
-            total_time_str = "{} seconds".format(total_secs)
-        else:
-            total_time_str = "{} minutes {} seconds".format(total_secs/60, total_secs%60)
-
-        s+= " * **Total**: {}\n".format(total_time_str)
+            if task_name not in stage_durations:
+                stage_durations[task_name] = []
+                stage_order.append(task_name)
+            stage_durations[task_name].append((output, entry["seconds_elapsed"]))
+            if "resources" in entry:
+                stage_resources.setdefault(task_name, []).append(entry["resources"])
+            session_total += entry["seconds_elapsed"]
+        session_durations.append((output, session_total))
+    stages = []
+    for name in stage_order:
+        stage = _summarize(stage_durations[name], nb_slowest)
+        stage["task_name"] = name
+        if name in stage_resources:
+            stage["subprocesses"] = sum(r["subprocesses"] for r in stage_resources[name])
+            stage["pooled_cpu_seconds"] = sum(_pooled_cpu_seconds(r) for r in stage_resources[name])
+        stages.append(stage)
+    process_resources = None
+    if process_cpu:
+        process_resources = {"cpu": _summarize(process_cpu, nb_slowest), "max_rss_kb": max(process_max_rss_kb)}
+    return {"sessions": len(statistics_files),
+            "stages": stages,
+            "session_totals": _summarize(session_durations, nb_slowest) if session_durations else None,
+            "process_resources": process_resources}
+
+
+def write_statistics_summary(statistics_files, outfile):
+    """ Writes the aggregated statistics as json """
+    with open(outfile, 'w') as f:
+        json.dump(aggregate_statistics(statistics_files), f, indent=2)
+
+
+def _markdown_summary_line(name, summary):
+    s = " * **{}** ({} runs): total {}, mean {}, p50 {}, p95 {}, max {}".format(
+        name, summary["count"], format_seconds(summary["total_seconds"]), format_seconds(summary["mean_seconds"]),
+        format_seconds(summary["p50_seconds"]), format_seconds(summary["p95_seconds"]),
+        format_seconds(summary["max_seconds"]))
+    if "subprocesses" in summary:
+        s += ", {} subprocesses, MATLAB pool cpu {}".format(summary["subprocesses"],
+                                                           format_seconds(summary["pooled_cpu_seconds"]))
+    return s + "\n"
+
+
+def get_markdown_from_statistics_files(statistics_files):
+    aggregated = aggregate_statistics(statistics_files)
+    s = "### Time Statistics for this run ({} sessions) ### \n".format(aggregated["sessions"])
+    if aggregated["session_totals"] is None:
+        return s
+    for stage in aggregated["stages"]:
+        s += _markdown_summary_line(stage["task_name"], stage)
+    s += _markdown_summary_line("Total per session", aggregated["session_totals"])
+    process_resources = aggregated["process_resources"]
+    if process_resources is not None:
+        s += (" * **Process-wide per session run** (includes whatever else ran in the same process): "
+              "cpu mean {}, max {}, peak rss {:.0f} MB\n").format(
+            format_seconds(process_resources["cpu"]["mean_seconds"]),
+            format_seconds(process_resources["cpu"]["max_seconds"]), process_resources["max_rss_kb"] / 1024.)
+    s += "\n**Slowest sessions**:\n"
+    for slowest in aggregated["session_totals"]["slowest"]:
+        s += " * {}: {}\n".format(slowest["output"], format_seconds(slowest["seconds_elapsed"]))
     return s
 
 
+def _pooled_cpu_seconds(resources):
+    """ cpu time of the MATLAB pool processes running the jobs of a task (see resource_usage) """
+    return resources["pooled_user_cpu_seconds"] + resources["pooled_system_cpu_seconds"]
+
+
+def _process_cpu_seconds(process_resources):
+    """ cpu time of the process and the children it waited for (see resource_usage) """
+    return (process_resources["user_cpu_seconds"] + process_resources["system_cpu_seconds"] +
+            process_resources["children_user_cpu_seconds"] + process_resources["children_system_cpu_seconds"])
+
+
+def _process_max_rss_kb(process_resources):
+    """ peak rss of the process or of its biggest child since the process started """
+    return max(process_resources["process_max_rss_kb"], process_resources["process_children_max_rss_kb"])
+
+
 def green(text):
     return '\x1b[6;30;42m' + text + '\x1b[0m'
 
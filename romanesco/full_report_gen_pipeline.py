@@ -1,13 +1,20 @@
 import os
 from tt_backend.utils import env, filenames
 
-from evaluation2.pipeline2 import SingleSessionPipeline, MultiSessionPipeline
+from evaluation2.pipeline2 import SingleSessionPipeline, MultiSessionPipeline, write_statistics
 from evaluation2.nb_utils import overwrite_input_folders_and_generate
-from evaluation2.common_pipelines import  create_sima_imu_fa_pipeline, create_repos_pipeline 
+from evaluation2.common_pipelines import  create_sima_imu_fa_pipeline, create_repos_pipeline, get_repo_commit_hashes
+from evaluation2.github_tasks import get_commit_hash_resolver
 from evaluation2.copy_tasks import SymlinkGroundTruth
+from evaluation2.download_tasks import resolve_calibration_dates
+from evaluation2.sima_task import resolve_input_digests
+from evaluation2.formatting import write_statistics_summary
 
 __author__ = 'carolinux'
 
+# the aggregated statistics of the sessions are written next to the report
+STATISTICS_SUMMARY_SUFFIX = ".statistics.json"
+
 
 class FetchRepos(SingleSessionPipeline):
     """ Fetch the necessary repos to do the full end to end pipeline """
@@ -34,7 +41,8 @@ class EndToEndFa(SingleSessionPipeline):
         have_matlab_license = env.get_true_false_env_value("HAVE_MATLAB_LICENSE", optional=False)
         sima, imu, imu_cal, fa = create_sima_imu_fa_pipeline(base_dir, tracker_id, input_bin=raw_binary,
                 repo_tasks=repo_tasks, calibration_dt=calibration_dt, have_matlab_license=have_matlab_license)
-        ground_truth_copy = SymlinkGroundTruth(in_dir=directory_with_ground_truth, out_dir=fa.output(), force=True)
+        ground_truth_copy = SymlinkGroundTruth(in_dir=directory_with_ground_truth, out_dir=fa, force=True)
+        ground_truth_copy.add_previous_task(fa) # it writes into the fa output directory
         self.tasks = [sima, imu_cal, imu, fa, ground_truth_copy]
 
     def output(self):
@@ -62,8 +70,9 @@ class ReportGenerationPipeline(MultiSessionPipeline):
         self.notebook = notebook
         self.output_file = output_file
 
-        self.update_state("Initializing task - determining calibration dates")
+        self.update_state("Initializing task")
         self.pipelines = []
+        self.statistics_files = {}
         self.fetch_repos = FetchRepos(base_dir=base_dir, fa_hash=fa_hash, gtsam_hash=gtsam_hash)
         for raw_bin, grt_dir, tracker_id in input_data:
             pipeline =  EndToEndFa(raw_binary=raw_bin,
@@ -76,29 +85,39 @@ class ReportGenerationPipeline(MultiSessionPipeline):
     def get_all_contained_single_session_pipelines(self):
         return self.pipelines
 
+    def get_all_session_tasks(self):
+        return [task for pipeline in self.pipelines for task in pipeline.tasklist()]
+
+    def resolve_outputs(self):
+        self.update_state("Running prerequisites: Determining calibration dates")
+        resolve_calibration_dates(self.get_all_session_tasks())
+        self.update_state("Running prerequisites: Hashing the input bins")
+        resolve_input_digests(self.get_all_session_tasks())
+
     def run_before_sessions(self):
         self.update_state("Running prerequisites: Fetching repos")
-        self.fetch_repos.run(force=self.force)
+        self.fetch_repos.run(force=self.force, evict=False)
 
 
+    def on_session_finished(self, index, session_result):
+        """ Write out the statistics of the session while the others are still running """
+        outfile = os.path.join(session_result["output"], filenames.EV2_TIME_STATS_FN)
+        write_statistics(outfile, session_result["statistics"], session_result["output"],
+                         process_resources=session_result.get("process_resources"))
+        self.statistics_files[index] = outfile
+
     def run_after_sessions(self, session_results):
         """
          Generate the report
         """
         self.update_state("Creating report")
-        fa_folders = [r.result[0] for r in session_results]
-        pipelines = [r.result[1] for r in session_results]
-        # write out statistics
-        # For now writing just the statistics of the first two sessions
-        stat_files = []
-        for pipeline, fa_folder in zip(pipelines, fa_folders)[:2]:
-            outfile = os.path.join(fa_folder, filenames.EV2_TIME_STATS_FN)
-            pipeline.write_statistics(outfile)
-            stat_files.append(outfile)
+        fa_folders = [r["output"] for r in session_results]
+        stat_files = [self.statistics_files[index] for index in range(len(session_results))]
+        write_statistics_summary(stat_files, self.output_file + STATISTICS_SUMMARY_SUFFIX)
         # generate notebook
         try:
             overwrite_input_folders_and_generate(self.notebook, self.output_file, replace_dict={"input_folders":fa_folders},
-                                                 statistics_files=stat_files)
+                                                 statistics_files=stat_files, use_cache=not self.force)
         except Exception as e:
             raise Exception("Generating notebook {} failed.<br>{}".format(self.notebook, e))
         return self.output_file
@@ -122,10 +141,13 @@ class ReportGenerationPipelineCommmitDiff(MultiSessionPipeline):
         self.notebook = notebook
         self.output_file = output_file
 
-        self.update_state("Initializing task - determining calibration dates")
+        self.update_state("Initializing task")
         self.pipelines = []
         self.fa_hash1 = fa_hash1
         self.fa_hash2 = fa_hash2
+        # look up the hashes of both commits at once
+        get_commit_hash_resolver().resolve_all(get_repo_commit_hashes(fa_hash=fa_hash1, gtsam_hash=gtsam_hash) +
+                                               get_repo_commit_hashes(fa_hash=fa_hash2, gtsam_hash=gtsam_hash))
         self.fetch_repos1 = FetchRepos(base_dir=base_dir, fa_hash=fa_hash1, gtsam_hash=gtsam_hash)
         self.fetch_repos2 = FetchRepos(base_dir=base_dir, fa_hash=fa_hash2, gtsam_hash=gtsam_hash)
         for repos in [self.fetch_repos1, self.fetch_repos2]:
@@ -139,11 +161,20 @@ class ReportGenerationPipelineCommmitDiff(MultiSessionPipeline):
     def get_all_contained_single_session_pipelines(self):
         return self.pipelines
 
+    def get_all_session_tasks(self):
+        return [task for pipeline in self.pipelines for task in pipeline.tasklist()]
+
+    def resolve_outputs(self):
+        self.update_state("Running prerequisites: Determining calibration dates")
+        resolve_calibration_dates(self.get_all_session_tasks())
+        self.update_state("Running prerequisites: Hashing the input bins")
+        resolve_input_digests(self.get_all_session_tasks())
+
     def run_before_sessions(self):
         self.update_state("Running prerequisites: Fetching repos - first commit hash {}".format(self.fa_hash1))
-        self.fetch_repos1.run(force=self.force)
+        self.fetch_repos1.run(force=self.force, evict=False)
         self.update_state("Running prerequisites: Fetching repos - second commit hash {}".format(self.fa_hash2))
-        self.fetch_repos2.run(force=self.force)
+        self.fetch_repos2.run(force=self.force, evict=False)
 
 
     def run_after_sessions(self, session_results):
@@ -153,13 +184,13 @@ class ReportGenerationPipelineCommmitDiff(MultiSessionPipeline):
         self.update_state("Creating report")
         # generate notebook
         middle_idx = len(session_results)/2
-        fa_folders1 = [r.result[0] for r in session_results[:middle_idx]]
-        fa_folders2 = [r.result[0] for r in session_results[middle_idx:]]
+        fa_folders1 = [r["output"] for r in session_results[:middle_idx]]
+        fa_folders2 = [r["output"] for r in session_results[middle_idx:]]
 
         try:
             overwrite_input_folders_and_generate(self.notebook, self.output_file, replace_dict={
                 "input_folders1":fa_folders1, "input_folders2": fa_folders2, "input_folders":[
-                fa_folders1[0], fa_folders2[0]]})
+                fa_folders1[0], fa_folders2[0]]}, use_cache=not self.force)
         except Exception as e:
             import traceback
             raise Exception("Generating notebook {} failed.<br>{} {}".format(self.notebook, e, traceback.format_exc()))
@@ -1,27 +1,131 @@
+from contextlib import contextmanager
+import fcntl
 import os
 import shutil
+import subprocess
 
 from tt_api import data as tt_data, commits
-from tt_backend.utils import Fn, pipeline, Files
+from tt_backend.utils import Fn, pipeline, Files, env
 
 from tasks import FileOutputTask
+from lookup_cache import TTLCache, map_concurrently
+from resource_usage import record_subprocess
 
 
 
 COMPILES_PREVIOUS_VERSION = "Compiles previous version"
+# seconds during which the resolved symbolic commit hashes are reused
+COMMIT_HASH_CACHE_TTL = 300
+# symbolic commit hash -> title the commit needs to have (None for any)
+SYMBOLIC_COMMIT_HASHES = {"latest": None,
+                          "latest_compiled": COMPILES_PREVIOUS_VERSION} # only for MATLAB
+
+
+class CommitHashResolver(object):
+    """ Resolves the symbolic commit hashes ("latest", "latest_compiled") of repos, caching
+    the result for a short time so that the pipelines of a report all agree on the hashes """
+
+    def __init__(self, ttl=COMMIT_HASH_CACHE_TTL):
+        self._hashes = TTLCache(ttl)
+
+    def resolve(self, repo, commit_hash):
+        if commit_hash not in SYMBOLIC_COMMIT_HASHES:
+            return commit_hash
+        title = SYMBOLIC_COMMIT_HASHES[commit_hash]
+
+        def lookup():
+            if title is None:
+                return commits.get_latest_commit_hash(repo=repo)
+            return commits.get_latest_commit_hash(repo=repo, title=title)
+        return self._hashes.get((repo, commit_hash), lookup)
+
+    def resolve_all(self, repo_commit_hashes):
+        """ Resolves a list of (repo, commit hash) concurrently.
+
+        Returns:
+            dict: (repo, commit hash) -> resolved commit hash
+        """
+        pairs = sorted(set(repo_commit_hashes))
+        return dict(zip(pairs, map_concurrently(lambda pair: self.resolve(*pair), pairs)))
+
+
+_commit_hash_resolver = CommitHashResolver()
+
+
+def get_commit_hash_resolver():
+    """ The resolver shared by all the tasks of the process """
+    return _commit_hash_resolver
+
+class GitMirror(object):
+    """ A local bare mirror of a repository. Commits are materialized from it as worktrees,
+    so that checking out another commit only fetches the new objects and writes the files
+    of that commit, instead of cloning the whole repository again """
+
+    def __init__(self, url, mirror_dir):
+        self.url = url
+        self.mirror_dir = mirror_dir
+
+    def git(self, *args):
+        record_subprocess()
+        subprocess.check_call(["git", "--git-dir", self.mirror_dir] + list(args))
+
+    @contextmanager
+    def lock(self):
+        """ Only one process at a time fetches into or adds worktrees to the mirror """
+        Files.make_dir_if_not_exists(os.path.dirname(self.mirror_dir))
+        with open(self.mirror_dir + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def has_commit(self, commit_hash):
+        record_subprocess()
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(["git", "--git-dir", self.mirror_dir, "cat-file", "-e", commit_hash+"^{commit}"],
+                                   stdout=devnull, stderr=devnull) == 0
+
+    def update(self):
+        if not os.path.exists(self.mirror_dir):
+            record_subprocess()
+            subprocess.check_call(["git", "clone", "--mirror", self.url, self.mirror_dir])
+        else:
+            self.git("remote", "update", "--prune")
+
+    def checkout(self, commit_hash, target_dir):
+        with self.lock():
+            if not os.path.exists(self.mirror_dir) or not self.has_commit(commit_hash):
+                self.update()
+            # forget the worktrees whose directories have been deleted
+            self.git("worktree", "prune")
+            self.git("worktree", "add", "--detach", target_dir, commit_hash)
+
 
 class CheckoutTTRepoFromWeb(FileOutputTask):
+    """ Checks out a commit of a repository.
+
+    Two backends are available (checkout_backend, by default TT_EVALUATION2_CHECKOUT_BACKEND or "mirror"):
+        clone: clones the repository for every commit
+        mirror: keeps a bare mirror of the repository in base_dir/.mirrors and adds a worktree per commit
+    """
 
-    def __init__(self, repo="", commit_hash="latest", base_dir="/tmp", **kwargs):
+    REPO_URL_TEMPLATE = "git@bitbucket.org:tracktics/{}.git"
+    MIRRORS_DIR = ".mirrors"
+
+    def __init__(self, repo="", commit_hash="latest", base_dir="/tmp", repo_url=None, checkout_backend=None, **kwargs):
 
         # no need to pass base dir into the task constructor
         super(CheckoutTTRepoFromWeb, self).__init__(**kwargs)
 
         self.repo = repo
-        if commit_hash == "latest":
-            commit_hash = commits.get_latest_commit_hash(repo=self.repo)
-        elif commit_hash == "latest_compiled": # only for MATLAB
-            commit_hash = commits.get_latest_commit_hash(repo=self.repo, title=COMPILES_PREVIOUS_VERSION)
+        self.repo_url = repo_url or self.REPO_URL_TEMPLATE.format(repo)
+        if checkout_backend is None:
+            checkout_backend = env.get_env_value("TT_EVALUATION2_CHECKOUT_BACKEND", optional=True) or "mirror"
+        if checkout_backend not in ("clone", "mirror"):
+            raise Exception("Unknown checkout backend {}".format(checkout_backend))
+        self.checkout_backend = checkout_backend
+        commit_hash = get_commit_hash_resolver().resolve(self.repo, commit_hash)
         self.commit_hash = commit_hash
         self.base_dir = base_dir
         self.base_repo_dir = os.path.join(base_dir, "{}_{}".format(self.repo, self.commit_hash))
@@ -34,10 +138,15 @@ class CheckoutTTRepoFromWeb(FileOutputTask):
     def name(self):
         return "CheckoutTTRepoFromWeb"
 
+    def get_mirror(self):
+        return GitMirror(self.repo_url, os.path.join(self.base_dir, self.MIRRORS_DIR, self.repo + ".git"))
+
     def _run(self):
-        url = "git@bitbucket.org:tracktics/{}.git".format(self.repo)
         Files.make_dir_if_not_exists(self.base_repo_dir)
-        pipeline.checkout_code_from_url(url, self.commit_hash, self.base_repo_dir) 
+        if self.checkout_backend == "mirror":
+            self.get_mirror().checkout(self.commit_hash, self.output())
+        else:
+            pipeline.checkout_code_from_url(self.repo_url, self.commit_hash, self.base_repo_dir) 
 
     def output(self):
         return os.path.join(self.base_repo_dir, self.repo) # checkout code from url creates the repo on that folder
@@ -0,0 +1,28 @@
+""" Helpers for the small sqlite databases keeping local state (caches and indexes) """
+import os
+import sqlite3
+
+from tt_backend.utils import Files
+
+# seconds to wait for another process holding a lock on the database
+LOCK_TIMEOUT = 60
+
+
+def connect(db_file, schema=()):
+    """ Opens the database, creating it and its tables if needed.
+
+    Connections are cheap to open and can't be shared between threads or forked
+    processes, so callers open one per operation and close it afterwards.
+
+    Args:
+        db_file: path to the sqlite file
+        schema: list of statements (CREATE TABLE IF NOT EXISTS ...) to run on opening
+    """
+    directory = os.path.dirname(db_file)
+    if directory:
+        Files.make_dir_if_not_exists(directory)
+    conn = sqlite3.connect(db_file, timeout=LOCK_TIMEOUT)
+    for statement in schema:
+        conn.execute(statement)
+    conn.commit()
+    return conn
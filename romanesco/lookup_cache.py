@@ -0,0 +1,58 @@
+""" In-memory caching and batching of the remote lookups (calibration service, commit hashes)
+done while setting up pipelines """
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+DEFAULT_MAX_CONCURRENT_LOOKUPS = 8
+
+
+class TTLCache(object):
+    """ Thread-safe memo of values that expire ttl seconds after they were computed.
+    Concurrent requests for the same missing key compute the value only once """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = {} # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _get_valid(self, key):
+        entry = self._values.get(key)
+        if entry is not None and entry[0] > time.time():
+            return True, entry[1]
+        return False, None
+
+    def get(self, key, compute):
+        """ Returns the cached value for key, or calls compute() to get it """
+        with self._lock:
+            found, value = self._get_valid(key)
+            if found:
+                return value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                found, value = self._get_valid(key)
+            if found:
+                return value
+            value = compute()
+            with self._lock:
+                self._values[key] = (time.time() + self.ttl, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+def map_concurrently(func, items, max_concurrent=DEFAULT_MAX_CONCURRENT_LOOKUPS):
+    """ Like map, but calls func on up to max_concurrent items at the same time """
+    items = list(items)
+    if len(items) <= 1:
+        return map(func, items)
+    pool = ThreadPool(min(max_concurrent, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
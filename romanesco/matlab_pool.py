@@ -0,0 +1,209 @@
+""" Pool of long-lived MATLAB processes, so that the tasks calling MATLAB code don't pay for
+starting MATLAB and loading the toolboxes on every run.
+
+Each worker process is started with the startup commands of the jobs it runs (for instance
+the addpath of the gtsam toolbox) and then receives jobs as statements on its stdin. A worker
+only runs jobs of one code directory, so that the paths, globals and cached functions left by
+a job can't be picked up by the code of another commit. The end
+of each job is recognized by a line the job prints when it finishes or fails. Workers are
+recycled after TT_EVALUATION2_MATLAB_POOL_MAX_JOBS jobs (default 20) and after a failure.
+
+The pool is used when TT_EVALUATION2_MATLAB_POOL_SIZE is set to the number of MATLAB
+processes to keep per worker process. TT_EVALUATION2_MATLAB_COMMAND overrides the command
+starting MATLAB ({matlab_home} is replaced), for instance with the fake MATLAB of
+fake_matlab.py (see check_matlab_pool).
+"""
+import atexit
+import os
+import shlex
+import subprocess
+import threading
+import uuid
+
+from tt_backend.utils import env
+
+from evaluation2.resource_usage import record_pooled_cpu, read_process_cpu, record_subprocess
+
+DEFAULT_MATLAB_COMMAND = "{matlab_home}/bin/matlab -nodisplay -nosplash -nodesktop"
+DEFAULT_MAX_JOBS_PER_WORKER = 20
+JOB_MARKER = "EVALUATION2_MATLAB_JOB_"
+# seconds to wait for a worker to exit before killing it
+EXIT_TIMEOUT = 10
+
+
+class MatlabJobFailed(Exception):
+    pass
+
+
+def matlab_string(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def job_statement(statements, job_id):
+    """ Wraps the statements so that they print a line with the job id and the outcome
+    when they are done. The marker is concatenated by MATLAB, so that echoing the statement
+    doesn't print it """
+    marker = "['{}' '{}".format(JOB_MARKER, job_id)
+    return "try, {} disp({}_OK']); catch err, disp({}_FAILED ' strrep(getReport(err), char(10), ' ')]); end\n".format(
+        statements, marker, marker)
+
+
+class MatlabWorker(object):
+    """ A MATLAB process running jobs one after the other """
+
+    def __init__(self, command, startup_commands=""):
+        record_subprocess()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, bufsize=1)
+        self.jobs_done = 0
+        # cpu seconds (user, system) of the process already recorded for the tasks
+        self._cpu_recorded = (0., 0.)
+        if startup_commands:
+            try:
+                self._call(startup_commands)
+            except Exception:
+                self.close()
+                raise
+
+    def _record_cpu(self):
+        """ The process isn't waited for, so its cpu time isn't in the rusage of the children.
+        What it used since the last job (starting MATLAB for the first one) is recorded for the task """
+        user, system = read_process_cpu(self.process.pid)
+        if user is None:
+            return
+        record_pooled_cpu(user - self._cpu_recorded[0], system - self._cpu_recorded[1])
+        self._cpu_recorded = (user, system)
+
+    def _call(self, statements):
+        try:
+            self._send(statements)
+        finally:
+            self._record_cpu()
+
+    def _send(self, statements):
+        job_id = uuid.uuid4().hex
+        self.process.stdin.write(job_statement(statements, job_id))
+        self.process.stdin.flush()
+        done_marker = JOB_MARKER + job_id
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise MatlabJobFailed("MATLAB exited with code {} while running {}".format(
+                    self.process.wait(), statements))
+            if done_marker in line:
+                outcome = line[line.index(done_marker) + len(done_marker):].strip()
+                if outcome != "_OK":
+                    raise MatlabJobFailed("MATLAB error in {}: {}".format(statements, outcome[len("_FAILED"):].strip()))
+                return
+            print line.rstrip("\n")
+
+    def run(self, function, code_directory, args):
+        """ Calls the function of the code directory with the (string) args """
+        statement = "cd({}); {}({});".format(matlab_string(code_directory), function,
+                                             ", ".join(matlab_string(arg) for arg in args))
+        self._call(statement)
+        self.jobs_done += 1
+
+    def close(self):
+        if self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.write("exit\n")
+            self.process.stdin.close()
+        except IOError:
+            pass # it already exited
+        timer = threading.Timer(EXIT_TIMEOUT, self.process.kill)
+        timer.start()
+        try:
+            self.process.wait()
+        finally:
+            timer.cancel()
+
+
+class MatlabPool(object):
+    """ At most size MATLAB workers, reused by the jobs with the same MATLAB installation,
+    startup commands and code directory """
+
+    def __init__(self, size, max_jobs_per_worker=DEFAULT_MAX_JOBS_PER_WORKER, command=DEFAULT_MATLAB_COMMAND):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.command = command
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._idle = {} # (matlab_home, startup_commands, code_directory) -> idle workers
+        self._nb_workers = 0
+
+    def _take_worker(self, key):
+        with self._lock:
+            if self._idle.get(key):
+                return self._idle[key].pop()
+            if self._nb_workers >= self.size:
+                # make room by stopping an idle worker started for other jobs
+                other_key = next(k for k, workers in self._idle.iteritems() if workers)
+                to_close = self._idle[other_key].pop()
+                self._nb_workers -= 1
+            else:
+                to_close = None
+            self._nb_workers += 1
+        if to_close is not None:
+            to_close.close()
+        matlab_home, startup_commands, _ = key
+        try:
+            return MatlabWorker(shlex.split(self.command.format(matlab_home=matlab_home)), startup_commands)
+        except Exception:
+            with self._lock:
+                self._nb_workers -= 1
+            raise
+
+    def _discard_worker(self, worker):
+        with self._lock:
+            self._nb_workers -= 1
+        worker.close()
+
+    def run(self, function, code_directory, args, matlab_home, startup_commands=""):
+        """ Runs the function on a worker of the pool, starting one if needed """
+        key = (matlab_home, startup_commands, os.path.abspath(code_directory))
+        with self._slots:
+            worker = self._take_worker(key)
+            try:
+                worker.run(function, code_directory, args)
+            except Exception:
+                self._discard_worker(worker)
+                raise
+            if worker.jobs_done >= self.max_jobs_per_worker:
+                self._discard_worker(worker)
+            else:
+                with self._lock:
+                    self._idle.setdefault(key, []).append(worker)
+
+    def close(self):
+        with self._lock:
+            workers = [worker for workers in self._idle.itervalues() for worker in workers]
+            self._idle = {}
+            self._nb_workers -= len(workers)
+        for worker in workers:
+            worker.close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_matlab_pool():
+    """ Returns the pool of this process, or None if the pool is disabled """
+    global _pool, _pool_pid
+    size = int(env.get_env_value("TT_EVALUATION2_MATLAB_POOL_SIZE", optional=True) or 0)
+    if size <= 0:
+        return None
+    with _pool_lock:
+        # forked processes get their own pool, the MATLAB processes belong to the parent
+        if _pool is None or _pool_pid != os.getpid():
+            max_jobs = env.get_env_value("TT_EVALUATION2_MATLAB_POOL_MAX_JOBS", optional=True)
+            command = env.get_env_value("TT_EVALUATION2_MATLAB_COMMAND", optional=True)
+            _pool = MatlabPool(size, max_jobs_per_worker=int(max_jobs or DEFAULT_MAX_JOBS_PER_WORKER),
+                               command=command or DEFAULT_MATLAB_COMMAND)
+            _pool_pid = os.getpid()
+            atexit.register(_pool.close)
+        return _pool
+
@@ -4,7 +4,10 @@ import os
 from tt_backend.utils import filenames, env, Files
 from tt_backend.utils import pipeline # matlab pipeline utilities
 
-from tasks import FileOutputTask
+from tasks import FileOutputTask, output_of
+import matlab_pool
+import staging
+from resource_usage import record_subprocess
 
 class MatlabTask(object):
 
@@ -17,6 +20,20 @@ class MatlabTask(object):
         ml_home = self.matlab_home()
         return os.path.join(ml_home, "sys", "opengl", "lib", "glnxa64")
 
+    def run_matlab(self, function, code_directory, args, run_before_matlab=None):
+        """ Runs the function of the MATLAB code directory, on the MATLAB pool of the process if
+        it is enabled (see matlab_pool), otherwise in a new MATLAB process """
+        pool = matlab_pool.get_matlab_pool()
+        if pool is not None:
+            pool.run(function, code_directory, args, self.matlab_home(), startup_commands=run_before_matlab or "")
+        elif run_before_matlab is not None:
+            record_subprocess()
+            pipeline.run_matlab_batch_mode(function, self.matlab_home(), code_directory, args=args,
+                                           run_before_matlab=run_before_matlab)
+        else:
+            record_subprocess()
+            pipeline.run_matlab_batch_mode(function, self.matlab_home(), code_directory, args=args)
+
     def format_directory_for_matlab(self, directory):
         # sometimes we have issues combining paths
         if not directory.endswith("/"):
@@ -31,7 +48,7 @@ class ImuPreprocess(FileOutputTask, MatlabTask):
                  **kwargs):
         """ 
         Args:
-            use_calibration_before: Datetime. Calibration values need to have a date in the database that is before this date
+            calibration_json: path to the calibration json, or the task producing it
             matlab_installed: If true, run the code via matlab. If not, launch a compiled binary
         """
         super(ImuPreprocess, self).__init__(**kwargs)
@@ -47,22 +64,23 @@ class ImuPreprocess(FileOutputTask, MatlabTask):
         return "ImuPreprocessor"
 
     def output(self):
-        """Returns the imu pp directory (with symlinked sima)"""
-        return self.sima_dir+"_imupp_"+self.checksum()[:10]
+        """Returns the imu pp directory (with the sima files in its stage manifest)"""
+        return self.sima_dir+"_imupp_"+self.checksum()
 
     def _run(self):
         sima_directory = self.sima_dir
         imu_pp_directory = self.output()
         Files.make_dir_if_not_exists(imu_pp_directory)
-        Files.create_symlinks(sima_directory, imu_pp_directory, filenames.SIMA_FNS, silently_skip_if_src_not_exists=True)
+        staging.add_source(imu_pp_directory, sima_directory, filenames.SIMA_FNS)
         args = [self.format_directory_for_matlab(sima_directory),
-                self.format_directory_for_matlab(imu_pp_directory), self.calibration_json]
+                self.format_directory_for_matlab(imu_pp_directory), output_of(self.calibration_json)]
         if self.matlab_installed:
             preprocessor_code_directory = os.path.join(self.imu_pp_code_directory, "IMU_preprocessor")
-            pipeline.run_matlab_batch_mode("main", self.matlab_home(), preprocessor_code_directory, args=args)
+            self.run_matlab("main", preprocessor_code_directory, args)
         else:
             # try compiled matlab
             shell_script = os.path.join(self.imu_pp_code_directory, "main", "for_testing", "run_main.sh") 
+            record_subprocess()
             pipeline.run_matlab_shell_script(shell_script, self.matlab_home(), *args)
 
 class FuseKnowtion(FileOutputTask, MatlabTask):
@@ -71,7 +89,7 @@ class FuseKnowtion(FileOutputTask, MatlabTask):
 
         super(FuseKnowtion, self).__init__(**kwargs)
         self.matlab_installed = matlab_installed
-        self.sima_dir = sima_dir # this directory should also have the imu preprocessed files
+        self.sima_dir = sima_dir # this directory (or the task producing it) should also have the imu preprocessed files
         self.fa_knowtion_code_directory = fa_knowtion_code_directory
         self.gtsam_dir = gtsam_dir
         # TODO: Have the option to use custom params for fa
@@ -83,11 +101,11 @@ class FuseKnowtion(FileOutputTask, MatlabTask):
         return "FusionAlgorithmKnowtion"
 
     def output(self):
-        """Returns the fa directory (with symlinked sima and imu)"""
+        """Returns the fa directory (with the sima and imu files in its stage manifest)"""
         fa_hash = self.settings()["tracktics-knowtion_commit_hash"]
         # TODO: Write function to get settings and allow "missing" or unknown
         #max_date = self.settings()["calibration_max_date"]
-        return self.sima_dir+"_fahash_"+fa_hash+"_faparam_checksum_"+self.checksum()[:10]
+        return output_of(self.sima_dir)+"_fahash_"+fa_hash+"_faparam_checksum_"+self.checksum()
 
     def add_gtsam_to_matlab_path(self):
         # add the gtsam library to the matlab bin path
@@ -100,23 +118,26 @@ class FuseKnowtion(FileOutputTask, MatlabTask):
                 # Can get timing errors here
                 pass
         print("Creating symlink from {} to {}".format(self.get_gtsam_so(), self.get_symlink_path_for_gtsam_so()))
+        record_subprocess()
         os.system('ln -sf  {} {}'.format(self.get_gtsam_so(), self.get_symlink_path_for_gtsam_so()))
 
     def _run(self):
-        sima_directory = self.sima_dir
+        sima_directory = output_of(self.sima_dir)
         self.add_gtsam_to_matlab_path()
         fa_directory = self.output()
         Files.make_dir_if_not_exists(fa_directory)
-        Files.create_symlinks(sima_directory, fa_directory, filenames.SIMA_FNS + filenames.IMU_PP_FNS, silently_skip_if_src_not_exists=True)
+        staging.add_source(fa_directory, sima_directory, filenames.SIMA_FNS + filenames.IMU_PP_FNS)
         output_fused = os.path.join(fa_directory, filenames.FUSION_RESULTS_FN)
-        args = [self.format_directory_for_matlab(sima_directory), output_fused]
-        if self.matlab_installed:
-            pipeline.run_matlab_batch_mode("entryPoint", self.matlab_home(),
-                    self.fa_knowtion_code_directory, args=args,
-                    run_before_matlab=self.load_gtsam_cmd())
-        else:
-            shell_script = os.path.join(self.fa_knowtion_code_directory, "fa_knowtion", "for_testing", "run_fa_knowtion.sh") 
-            pipeline.run_matlab_shell_script(shell_script, self.matlab_home(), *args)
+        # the fusion code expects the sima and imu files in one directory
+        with staging.temporary_view(sima_directory) as input_directory:
+            args = [self.format_directory_for_matlab(input_directory), output_fused]
+            if self.matlab_installed:
+                self.run_matlab("entryPoint", self.fa_knowtion_code_directory, args,
+                        run_before_matlab=self.load_gtsam_cmd())
+            else:
+                shell_script = os.path.join(self.fa_knowtion_code_directory, "fa_knowtion", "for_testing", "run_fa_knowtion.sh") 
+                record_subprocess()
+                pipeline.run_matlab_shell_script(shell_script, self.matlab_home(), *args)
 
     def get_gtsam_home(self):
         return self.gtsam_dir
@@ -0,0 +1,109 @@
+""" Executing report notebooks in the current process, on a pool of jupyter kernels that
+are started in advance and have the heavy scientific libraries already imported. This
+avoids starting a new python process and a new kernel for every report, as
+jupyter nbconvert --execute does.
+
+Each kernel runs a single notebook, so that reports don't share any state. A new kernel
+is started and warmed up in the background to replace it.
+"""
+import Queue
+import threading
+
+from jupyter_client.manager import KernelManager
+from nbconvert import HTMLExporter
+from nbconvert.preprocessors import ExecutePreprocessor
+from tt_backend.utils import env
+
+DEFAULT_POOL_SIZE = 2
+KERNEL_STARTUP_TIMEOUT = 120
+EXECUTION_TIMEOUT = 100000
+WARMUP_CODE = """
+import numpy
+import pandas
+import matplotlib
+import matplotlib.pyplot
+"""
+
+
+class KernelPool(object):
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, warmup_code=WARMUP_CODE):
+        self.warmup_code = warmup_code
+        self._ready = Queue.Queue()
+        for _ in range(size):
+            self._start_kernel_in_background()
+
+    def _start_kernel(self):
+        try:
+            km = KernelManager()
+            km.start_kernel()
+            kc = km.client()
+            kc.start_channels()
+            try:
+                kc.wait_for_ready(timeout=KERNEL_STARTUP_TIMEOUT)
+                kc.execute_interactive(self.warmup_code, timeout=KERNEL_STARTUP_TIMEOUT)
+            finally:
+                kc.stop_channels()
+            self._ready.put((km, None))
+        except Exception as e:
+            self._ready.put((None, e))
+
+    def _start_kernel_in_background(self):
+        thread = threading.Thread(target=self._start_kernel)
+        thread.daemon = True
+        thread.start()
+
+    def acquire(self):
+        """ Waits for a warm kernel and returns its KernelManager """
+        km, error = self._ready.get()
+        if error is not None:
+            self._start_kernel_in_background()
+            raise Exception("Could not start a jupyter kernel: {}".format(error))
+        return km
+
+    def release(self, km):
+        """ Shuts the used kernel down and starts a replacement """
+        try:
+            # the execute preprocessor may already have shut it down
+            if km.is_alive():
+                km.shutdown_kernel(now=True)
+        finally:
+            self._start_kernel_in_background()
+
+    def execute(self, nb, cwd):
+        """ Executes the notebook in place, with cwd as working directory """
+        km = self.acquire()
+        try:
+            kc = km.client()
+            kc.start_channels()
+            try:
+                kc.execute_interactive("import os\nos.chdir({!r})".format(cwd), timeout=KERNEL_STARTUP_TIMEOUT)
+            finally:
+                kc.stop_channels()
+            ExecutePreprocessor(timeout=EXECUTION_TIMEOUT).preprocess(nb, {"metadata": {"path": cwd}}, km=km)
+        finally:
+            self.release(km)
+        return nb
+
+
+_kernel_pool = None
+_kernel_pool_lock = threading.Lock()
+
+
+def get_kernel_pool():
+    """ The pool of the current process, created on first use with
+    TT_EVALUATION2_KERNEL_POOL_SIZE kernels (default 2) """
+    global _kernel_pool
+    with _kernel_pool_lock:
+        if _kernel_pool is None:
+            size = env.get_env_value("TT_EVALUATION2_KERNEL_POOL_SIZE", optional=True)
+            _kernel_pool = KernelPool(size=int(size) if size else DEFAULT_POOL_SIZE)
+        return _kernel_pool
+
+
+def execute_and_export_html(nb, output_html, cwd):
+    """ Executes the notebook on a warm kernel and writes it out as html """
+    get_kernel_pool().execute(nb, cwd)
+    body, _ = HTMLExporter().from_notebook_node(nb)
+    with open(output_html, 'w') as f:
+        f.write(body.encode('utf-8'))
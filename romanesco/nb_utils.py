@@ -11,6 +11,9 @@ from nbparameterise import nbparameterise as nbparam
 from tt_backend.utils import env, Fn
 
 from evaluation2 import formatting as fmt
+from evaluation2 import nb_kernels, report_cache, staging
+from evaluation2.resource_usage import record_subprocess
+from evaluation2.task_catalog import load_output_settings
 
 def extract_session_ids_needed_from_ipynb(notebook_template):
     return read_variable_value(notebook_template, code_cell=1, variable_name="datasets")
@@ -31,54 +34,145 @@ def read_variable_value(ipynb, code_cell=1, variable_name="datasets"):
         raise Exception("Could not find variable with name {} in code cell {}".format(variable_name, code_cell))
     return value
 
-def overwrite_variable_values(ipynb_template, ipynb_out, code_cell, value_dict, execute=True):
-    """ Writes out the template to outfile with the variables overriden in the specified cell """
-    with open(ipynb_template) as f:
-        nb = nbformat.read(f, as_version=4)
+def read_notebook(ipynb):
+    with open(ipynb) as f:
+        return nbformat.read(f, as_version=4)
+
+def write_notebook(nb, ipynb):
+    with codecs.open(ipynb, 'w', encoding='utf-8') as f:
+       nbformat.write(nb, f)
+
+def replace_variable_values(nb, code_cell, value_dict, execute=True):
+    """ Returns the notebook with the variables overriden in the specified cell """
     orig_parameters = nbparam.extract_parameters(nb, n=code_cell)
     params = nbparam.parameter_values(orig_parameters, **value_dict)
-    new_nb = nbparam.replace_definitions(nb, params, execute=execute, n=code_cell)
-    with codecs.open(ipynb_out, 'w', encoding='utf-8') as f:
-       nbformat.write(new_nb, f)
+    return nbparam.replace_definitions(nb, params, execute=execute, n=code_cell)
 
-def add_custom_text(ipynb_out, text="test text", insert_index=1):
-    with open(ipynb_out) as f:
-            nb = nbformat.read(f, as_version=4)
+def insert_custom_text(nb, text="test text", insert_index=1):
+    """ Inserts a markdown cell in the notebook """
     metadata_cell = nbf.new_text_cell('markdown', text)
     nb.cells = nb.cells[:insert_index] + [metadata_cell] + nb.cells[insert_index:]
-    with codecs.open(ipynb_out, 'w', encoding='utf-8') as f:
-       nbformat.write(nb, f)
+    return nb
 
-def overwrite_input_folders_and_generate(notebook_template, output_html, replace_dict, statistics_files=None):
-    """ Replace dict has the variable names as the keys and the values of those variables as the values """
-    output_ipynb = output_html+".ipynb"
-    overwrite_variable_values(notebook_template, output_ipynb, code_cell=2,
-            value_dict=replace_dict, execute=False)
-    metadata_file = replace_dict["input_folders"][0]+".meta"
-    add_custom_text(output_ipynb, insert_index=1, text=fmt.format_metadata_as_markdown(metadata_file,
-                                                                                       title="Metadata of first session processed"))
+def overwrite_variable_values(ipynb_template, ipynb_out, code_cell, value_dict, execute=True):
+    """ Writes out the template to outfile with the variables overriden in the specified cell """
+    write_notebook(replace_variable_values(read_notebook(ipynb_template), code_cell, value_dict, execute=execute),
+                   ipynb_out)
+
+def add_custom_text(ipynb_out, text="test text", insert_index=1):
+    write_notebook(insert_custom_text(read_notebook(ipynb_out), text=text, insert_index=insert_index), ipynb_out)
+
+def _replace_paths(replace_dict, paths):
+    """ The replace dict with the paths in the values replaced according to the paths dict """
+    res = {}
+    for k, v in replace_dict.iteritems():
+        if isinstance(v, (list, tuple)):
+            res[k] = [paths.get(item, item) if isinstance(item, basestring) else item for item in v]
+        elif isinstance(v, basestring):
+            res[k] = paths.get(v, v)
+        else:
+            res[k] = v
+    return res
+
+def build_report_notebook(notebook_template, replace_dict, statistics_files=None, notebook_values=None):
+    """ Reads the template once and returns the report notebook, with the variables of the
+    replace dict set and the metadata and statistics cells added. notebook_values, if given,
+    are set in the notebook instead of the replace dict (for instance views of the input folders) """
+    nb = replace_variable_values(read_notebook(notebook_template), code_cell=2,
+            value_dict=replace_dict if notebook_values is None else notebook_values, execute=False)
+    settings = load_output_settings(replace_dict["input_folders"][0])
+    insert_custom_text(nb, insert_index=1, text=fmt.format_settings_as_markdown(settings,
+                                                                               title="Metadata of first session processed"))
     if len(replace_dict["input_folders"])>1:
-        metadata_file = replace_dict["input_folders"][1]+".meta"
-        add_custom_text(output_ipynb, insert_index=2, text=fmt.format_metadata_as_markdown(metadata_file,
+        settings = load_output_settings(replace_dict["input_folders"][1])
+        insert_custom_text(nb, insert_index=2, text=fmt.format_settings_as_markdown(settings,
                                 title="Metadata of second session processed or second commit processed"))
  
     if statistics_files is not None:
-        add_custom_text(output_ipynb, insert_index=1, text=fmt.get_markdown_from_statistics_files(statistics_files))
-    generate_html(output_ipynb, output_html)
+        insert_custom_text(nb, insert_index=1, text=fmt.get_markdown_from_statistics_files(statistics_files))
+    return nb
+
+def overwrite_input_folders_and_generate(notebook_template, output_html, replace_dict, statistics_files=None,
+                                         use_cache=True):
+    """ Replace dict has the variable names as the keys and the values of those variables as the values.
+    If use_cache is True and the same report was already generated for the same template and inputs,
+    the cached report is copied instead of executing the notebook again (see report_cache) """
+    cache_key = report_cache.report_cache_key(notebook_template, replace_dict) if use_cache else None
+    if cache_key is not None and report_cache.copy_cached_report(cache_key, html_file(output_html)):
+        print fmt.green("Report {} was already generated for the same inputs, using the cached one".format(output_html))
+        return
+    output_ipynb = output_html+".ipynb"
+    # the notebooks read the input folders as flat directories, they get temporary views of them
+    with staging.temporary_views(report_cache.input_folders(replace_dict)) as views:
+        nb = build_report_notebook(notebook_template, replace_dict, statistics_files=statistics_files,
+                                   notebook_values=_replace_paths(replace_dict, views))
+        write_notebook(nb, output_ipynb)
+        source_paths = dict((view, folder) for folder, view in views.iteritems())
+        generate_html(output_ipynb, output_html, nb=nb, source_paths=source_paths)
+    # kept next to the report for inspection, with the input folders instead of the removed views
+    restore_source_paths(output_ipynb, source_paths)
+    if cache_key is not None:
+        report_cache.store_report(cache_key, html_file(output_html))
+
+def html_file(output_html):
+    """ The file the html is written to (nbconvert adds the extension if missing) """
+    if not output_html.endswith(".html"):
+        return output_html + ".html"
+    return output_html
+
+def use_in_process_execution():
+    """ Notebooks are executed on a warm kernel of the process unless
+    TT_EVALUATION2_NOTEBOOK_EXECUTION is set to subprocess """
+    return env.get_env_value("TT_EVALUATION2_NOTEBOOK_EXECUTION", optional=True) != "subprocess"
+
+def restore_source_paths(ipynb, source_paths):
+    """ Rewrites the notebook file with the temporary paths replaced according to the
+    source_paths dict (temporary path -> path it stands for) """
+    if not source_paths:
+        return
+    with open(ipynb) as f:
+        content = f.read()
+    for temporary_path in sorted(source_paths, key=len, reverse=True):
+        content = content.replace(temporary_path, source_paths[temporary_path])
+    with open(ipynb, "w") as f:
+        f.write(content)
+
+def generate_html(ipynb, output_html, nb=None, source_paths=None):
+    """ Executes the notebook and exports it as html. nb is the already loaded notebook, if available.
+    source_paths is passed to restore_source_paths before a failed notebook is kept for inspection """
+    if use_in_process_execution():
+        generate_html_in_process(ipynb, output_html, nb=nb, source_paths=source_paths)
+    else:
+        generate_html_with_nbconvert(ipynb, output_html, source_paths=source_paths)
 
-def generate_html(ipynb, output_html):
+def generate_html_in_process(ipynb, output_html, nb=None, source_paths=None):
+    if nb is None:
+        nb = read_notebook(ipynb)
+    try:
+        nb_kernels.execute_and_export_html(nb, html_file(output_html), cwd=os.path.dirname(os.path.abspath(ipynb)))
+    except Exception as e:
+        # keep the partially executed notebook for inspection
+        write_notebook(nb, ipynb)
+        raise_notebook_failure(ipynb, "Executing notebook {} failed: {}".format(ipynb, e), source_paths=source_paths)
+
+def raise_notebook_failure(ipynb, message, source_paths=None):
+    restore_source_paths(ipynb, source_paths)
+    tt_webtools_home = env.get_env_value("TT_WEBTOOLS_HOME", optional=True)
+    if tt_webtools_home is not None:
+        _, fn, ext = Fn.fileparts(ipynb)
+        new_ipynb = os.path.join(tt_webtools_home, "notebooks", "dashboard", fn+ext)
+        shutil.copy(ipynb, new_ipynb)
+        raise Exception("{} Notebook has been copied to <a href={}>jupyter</a> for inspection"
+        .format(message, "http://evaluation.tracktics.zone:8888/notebooks/"+fn+ext))
+    else:
+        raise Exception(message)
+
+def generate_html_with_nbconvert(ipynb, output_html, source_paths=None):
     cmd = ["jupyter", "nbconvert", "--ExecutePreprocessor.timeout=100000", "--output", output_html,
                                 "--execute", ipynb,"--to", "html"]
     cmd2 = " ".join(cmd)
+    record_subprocess()
     try:
         subprocess.check_call(cmd2, shell=True)
     except Exception as e:
-        tt_webtools_home = env.get_env_value("TT_WEBTOOLS_HOME", optional=True)
-        if tt_webtools_home is not None:
-            _, fn, ext = Fn.fileparts(ipynb)
-            new_ipynb = os.path.join(tt_webtools_home, "notebooks", "dashboard", fn+ext)
-            shutil.copy(ipynb, new_ipynb)
-            raise Exception("Command: {} failed. Notebook has been copied to <a href={}>jupyter</a> for inspection"
-            .format(cmd2, "http://evaluation.tracktics.zone:8888/notebooks/"+fn+ext))
-        else:
-            raise Exception("Command: {} failed.".format(cmd2))
+        raise_notebook_failure(ipynb, "Command: {} failed.".format(cmd2), source_paths=source_paths)
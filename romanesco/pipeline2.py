@@ -1,30 +1,63 @@
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
 import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
 import time
 
-from celery import group
+import billiard
+from celery import chord, group, uuid
+from celery.utils import worker_direct
+
+from evaluation2 import celeryapp, celery_utils, result_store, task_catalog
+from evaluation2.resource_usage import ResourceMonitor
+from evaluation2.descriptors import pipeline_to_descriptor, pipeline_from_descriptor, \
+    multi_session_pipeline_to_descriptor, multi_session_pipeline_from_descriptor
+
+DEFAULT_MAX_PARALLEL_TASKS = 4
+RESULT_RECORD_VERSION = 1
+
+
+def write_statistics(outfile, statistics, output, process_resources=None):
+    """ process_resources are the process-wide figures of the run (see resource_usage.ResourceMonitor) """
+    with open(outfile, 'w') as f:
+        json.dump({"statistics":statistics, "output": output, "process_resources": process_resources}, f)
+
 
-from evaluation2 import celeryapp, celery_utils
 
 class SingleSessionPipeline(object):
-    """A pipeline for which we assume no parallelization is possible,
-    so the tasks will be done linearly. This is just an abstraction
-    so that we don't have a lot of boilerplate when chaining tasks"""
+    """A pipeline of tasks for a single session. The tasks are run according to
+    the dependencies they declare with Task.add_previous_task, so that tasks that
+    do not depend on each other run at the same time on a bounded thread pool.
+    This is just an abstraction so that we don't have a lot of boilerplate when chaining tasks"""
 
-    def __init__(self, **kwargs):
+    def __init__(self, max_parallel_tasks=DEFAULT_MAX_PARALLEL_TASKS, **kwargs):
         # the default one is empty
         self.tasks = [] # Subclasses should add tasks to this list
         self._settings = kwargs
         self.last_output = None
         self.exec_stats = []
+        # process-wide resources used while the tasks ran, see resource_usage.ResourceMonitor
+        self.process_resources = None
+        self.max_parallel_tasks = max_parallel_tasks
+        # tasks found complete in the task catalog when the pipeline started
+        self._complete_tasks = set()
 
-    def update_statistics(self, task_name, seconds_elapsed):
-        self.exec_stats.append({"task_name":task_name, "seconds_elapsed":seconds_elapsed})
+    def update_statistics(self, task_name, seconds_elapsed, resources=None):
+        entry = {"task_name":task_name, "seconds_elapsed":seconds_elapsed}
+        if resources is not None:
+            entry["resources"] = resources
+        self.exec_stats.append(entry)
 
     def write_statistics(self, outfile):
-        with open(outfile, 'w') as f:
-            json.dump({"statistics":self.exec_stats, "output": self.output()}, f)
+        write_statistics(outfile, self.exec_stats, self.output(), process_resources=self.process_resources)
+
+    def result_record(self):
+        """ What is sent back from a worker after running the pipeline """
+        return {"version": RESULT_RECORD_VERSION, "output": self.output(), "statistics": self.exec_stats,
+                "process_resources": self.process_resources}
 
 
     def output(self):
@@ -37,45 +70,206 @@ class SingleSessionPipeline(object):
     def tasklist(self):
         return self.tasks
 
-    def run(self, force=False):
-        output = None
-        for task in self.tasklist():
-            task.run(force_defined_externally=force)
+    def task_dependencies(self):
+        """ Returns a dict with the tasks of the tasklist each task directly depends on.
+        Dependencies on tasks that are not part of the tasklist (for instance the shared
+        repo checkouts) are expected to have been run before the pipeline"""
+        tasks = self.tasklist()
+        return dict((task, [prev for prev in task.prev_tasks() if prev in tasks]) for task in tasks)
+
+    def outputs_in_use(self):
+        """ The outputs the pipeline reads or writes: the outputs of its tasks and of their upstream tasks """
+        outputs = set()
+        to_visit = list(self.tasklist())
+        while to_visit:
+            task = to_visit.pop()
             output = task.output()
-        self.last_output = output
-        return output
+            if output not in outputs:
+                outputs.add(output)
+                to_visit.extend(task.prev_tasks())
+        return outputs
 
+    def complete_tasks(self):
+        """ The tasks of the tasklist that are already complete, according to the task catalog.
+        Returns None if the catalog is disabled """
+        catalog = task_catalog.get_default_catalog()
+        if catalog is None:
+            return None
+        return catalog.complete_tasks(self.tasklist())
 
-@celeryapp.task
-def run_pipeline_celery(pipeline, force=False):
-    for task in pipeline.tasklist():
-        # can't update the state outside of a function tagged @celery unfortunately
-        run_pipeline_celery.update_state(state="Running task {}".format(task.name()), meta=str(task.settings()))
+    def execute_task(self, task, force=False):
+        """ Run a single task of the pipeline and keep track of how long it took and
+        of the resources that can be attributed to it (see resource_usage.ResourceMonitor) """
         start = datetime.now()
-        task.run(force_defined_externally=force)
+        with ResourceMonitor() as monitor:
+            task.run(force_defined_externally=force, known_complete=task in self._complete_tasks)
         end = datetime.now()
-        pipeline.update_statistics(task.name(), (end-start).total_seconds())
-    return pipeline.output(), pipeline
+        self.update_statistics(task.name(), (end-start).total_seconds(), resources=monitor.usage)
+
+    def run_tasks(self, run_task, evict=True):
+        """ Calls run_task for every task of the tasklist, as soon as all of the task's
+        dependencies have finished. Independent tasks run concurrently, using at most
+        max_parallel_tasks threads. If a task fails, the tasks already running are
+        allowed to finish, no new tasks are started and the exception is re-raised.
+        Afterwards, outputs are evicted from the result store if it is enabled and evict is True.
+        """
+        store = result_store.get_default_store()
+        if store is None:
+            return self._run_tasks(run_task)
+        # make sure nothing this pipeline uses is evicted while it runs
+        pin_owner = store.pin(self.outputs_in_use())
+        try:
+            return self._run_tasks(run_task)
+        finally:
+            store.unpin(pin_owner)
+            if evict:
+                store.evict()
+
+    def _run_tasks(self, run_task):
+        monitor = ResourceMonitor()
+        try:
+            with monitor:
+                return self._schedule_tasks(run_task)
+        finally:
+            self.process_resources = monitor.process_usage
+
+    def _schedule_tasks(self, run_task):
+        tasks = self.tasklist()
+        # one catalog query for the whole pipeline instead of one per task
+        complete = self.complete_tasks()
+        self._complete_tasks = complete or set()
+        if complete is not None:
+            print "{} of {} tasks already complete".format(len(complete), len(tasks))
+        waiting_for = dict((task, set(deps)) for task, deps in self.task_dependencies().iteritems())
+        finished = Queue.Queue()
+
+        def run_and_notify(task):
+            try:
+                run_task(task)
+                finished.put((task, None))
+            except Exception:
+                finished.put((task, sys.exc_info()))
+
+        parallel_tasks = max(1, min(self.max_parallel_tasks, len(tasks)))
+        pool = ThreadPool(parallel_tasks)
+        try:
+            running = 0
+            while waiting_for or running:
+                # keep the tasklist order among the tasks that are ready. Only as many tasks as
+                # there are threads are submitted, so that none is started after a failure
+                ready = [t for t in tasks if t in waiting_for and not waiting_for[t]]
+                for task in ready[:parallel_tasks - running]:
+                    del waiting_for[task]
+                    pool.apply_async(run_and_notify, (task,))
+                    running += 1
+                if not running:
+                    raise Exception("Circular dependency between tasks {}".format(
+                        [task.name() for task in waiting_for]))
+                done_task, exc_info = finished.get()
+                running -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for deps in waiting_for.itervalues():
+                    deps.discard(done_task)
+        finally:
+            pool.close()
+            pool.join()
+        self.last_output = tasks[-1].output() if tasks else None
+        return self.last_output
+
+    def run(self, force=False, evict=True):
+        """ evict is False for pipelines run as prerequisites of other pipelines, which
+        may not have pinned their outputs yet (see MultiSessionPipeline.run) """
+        return self.run_tasks(lambda task: self.execute_task(task, force=force), evict=evict)
+
+
+def run_pipeline_descriptor(descriptor, force=False, on_task_start=None):
+    """ Runs the pipeline described by the descriptor (see evaluation2.descriptors)
+    and returns its result record. on_task_start is called with each task before it runs """
+    pipeline = pipeline_from_descriptor(descriptor)
+
+    def run_task(task):
+        if on_task_start is not None:
+            on_task_start(task)
+        pipeline.execute_task(task, force=force)
+    pipeline.run_tasks(run_task)
+    return pipeline.result_record()
+
+
+@celeryapp.task
+def run_pipeline_celery(descriptor, force=False):
+    # the tasks run on other threads, where the request of this task isn't set
+    task_id = run_pipeline_celery.request.id
+
+    def update_state(task):
+        # can't update the state outside of a function tagged @celery unfortunately
+        run_pipeline_celery.update_state(task_id=task_id, state="Running task {}".format(task.name()),
+                                         meta=str(task.settings()))
+    return run_pipeline_descriptor(descriptor, force=force, on_task_start=update_state)
 
 
 class MultiSessionPipeline(object):
 
     """A pipeline which runs some prep work, several single session pipelines in parallel,
     and does some aggregate
-    work after. When parellelism is not available, it can also be run in serial mode.
+    work after. How the sessions are run is up to the executor (see SessionExecutor): on celery
+    workers by default, or locally in serial mode, on threads or on processes.
+
+    With the celery executor, the pipeline waits for the sessions to finish and then does the
+    aggregate work. With wait_for_sessions=False, run returns as soon as the sessions are submitted
+    and the aggregate work runs as a celery chord callback when the last session finishes, so
+    that the parent task doesn't keep a worker busy while waiting. The callback then reports its
+    progress under the id of the parent task and marks it as done or failed at the end, so the
+    parent task should not store a result of its own (see report_gen_run).
     """
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, celery_parent_task=None, force=False):
+    def __init__(self, celery_parent_task=None, force=False, wait_for_sessions=True, executor=None):
 
         self.meta = celery_utils.generate_task_meta()
         self.force = force
         self.celery_parent_task = celery_parent_task
+        # the state is always reported under the id of the parent task, also by the chord callback
+        self._state_task_id = celery_parent_task.request.id if celery_parent_task is not None else None
+        if executor is None:
+            executor = CelerySessionExecutor(wait_for_sessions=wait_for_sessions)
+        self.executor = executor
+        self._pin_owner = None
+        # the worker whose local result store has the pins
+        self._pin_worker = None
+        self._finished_sessions = set()
 
+    def callback_descriptor(self):
+        """ Describes the pipeline for the chord callback and for releasing the pins on another
+        worker (see descriptors). The session pipelines, which already ran, the parent task and
+        the executor are left out """
+        excluded = set(["celery_parent_task", "executor"])
+        for name, value in self.__dict__.iteritems():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            if values and all(isinstance(v, SingleSessionPipeline) for v in values):
+                excluded.add(name)
+        return multi_session_pipeline_to_descriptor(self, excluded)
+
+    @property
+    def wait_for_sessions(self):
+        return self.executor.waits_for_sessions
 
     def update_state(self, state):
-        self.celery_parent_task.update_state(state=state, meta=self.meta)
+        if self.celery_parent_task is None:
+            print state
+            return
+        self.celery_parent_task.update_state(task_id=self._state_task_id, state=state, meta=self.meta)
+
+    def mark_done(self, result):
+        """ Stores the result of the pipeline as the result of the parent task """
+        if self._state_task_id is not None:
+            celeryapp.backend.mark_as_done(self._state_task_id, result)
+
+    def mark_failed(self):
+        if self._state_task_id is not None:
+            celeryapp.backend.mark_as_failure(self._state_task_id, Exception(
+                "The sessions or the report callback {} failed".format(self.meta.get("report_task_id"))))
 
     @abstractmethod
     def get_all_contained_single_session_pipelines(self):
@@ -84,31 +278,105 @@ class MultiSessionPipeline(object):
         """
         pass
 
+    def resolve_outputs(self):
+        """ Override this to resolve what the outputs of the sessions depend on (for instance
+        the calibration dates), before they are pinned. Nothing should be run here """
+        pass
+
     @abstractmethod
     def run_before_sessions(self, force=False):
         """ Do the preparatory work, for instance fetching repos etc
-        before starting the session processing
+        before starting the session processing. The pipelines run here should not evict
+        outputs (see SingleSessionPipeline.run), the session outputs are pinned by then
         """
         pass
 
     @abstractmethod
     def run_after_sessions(self, session_results, force=False):
         """ Do the post processing work after processing all sessions, for instance
-        making a report
+        making a report. session_results has the result records of the sessions
+        (see SingleSessionPipeline.result_record) in the order of
+        get_all_contained_single_session_pipelines
         """
         pass
 
+    def on_session_finished(self, index, session_result):
+        """ Override this to process the result of a session as soon as it is available,
+        while other sessions are still running. index is the position of the session in
+        get_all_contained_single_session_pipelines. It is called once per session,
+        before run_after_sessions
+        """
+        pass
+
+    def session_finished(self, index, session_result):
+        if index in self._finished_sessions:
+            return
+        self._finished_sessions.add(index)
+        self.on_session_finished(index, session_result)
+
+    def finish_sessions(self, session_results):
+        """ Processes the sessions that haven't been processed yet and does the aggregate work """
+        for index, session_result in enumerate(session_results):
+            self.session_finished(index, session_result)
+        return self.run_after_sessions(session_results)
+
     def get_each_single_session_pipeline_as_celery_task(self):
         tasks = []
         for pipeline in self.get_all_contained_single_session_pipelines():
-            session_pipeline_as_task = run_pipeline_celery.s(pipeline=pipeline, force=self.force)
+            session_pipeline_as_task = run_pipeline_celery.s(descriptor=pipeline_to_descriptor(pipeline),
+                                                             force=self.force)
             tasks.append(session_pipeline_as_task)
         return tasks
 
+    def pin_outputs(self):
+        """ Protect the outputs of the sessions, and the outputs they are derived from, from
+        eviction until release_outputs is called. The pins, like the catalog, are local to the
+        machine (see result_store) """
+        store = result_store.get_default_store()
+        if store is None:
+            return
+        outputs = set()
+        for pipeline in self.get_all_contained_single_session_pipelines():
+            outputs.update(pipeline.outputs_in_use())
+        self._pin_owner = store.pin(outputs)
+        if self.celery_parent_task is not None:
+            self._pin_worker = self.celery_parent_task.request.hostname
+
+    def release_outputs(self, current_worker=None):
+        """ current_worker is the name of the celery worker calling this, if any. The pins are
+        in the local database of the worker that made them, so they are released there """
+        if self._pin_owner is None:
+            return
+        if self._pin_worker is not None and current_worker is not None and current_worker != self._pin_worker:
+            release_outputs_celery.apply_async(kwargs={"descriptor": self.callback_descriptor()},
+                                               queue=worker_direct(self._pin_worker))
+            self._pin_owner = None
+            return
+        store = result_store.get_default_store()
+        if store is None:
+            return
+        store.unpin(self._pin_owner)
+        self._pin_owner = None
+        store.evict()
 
-    def run(self):
-        self.run_before_sessions()
-        return self.run_sessions_parallel()
+    def run(self, link=None, link_error=None):
+        """ Runs the whole pipeline and returns the result of run_after_sessions.
+        If wait_for_sessions is False, returns the AsyncResult of the chord callback instead.
+        link and link_error are signatures to call when the callback succeeds or fails
+        """
+        released_by_callback = False
+        try:
+            self.resolve_outputs()
+            # the session outputs are needed until the post processing is done. They are pinned
+            # before any pipeline runs, so that no eviction removes them in the meantime
+            self.pin_outputs()
+            self.run_before_sessions()
+            res = self.executor.run_sessions(self, link=link, link_error=link_error)
+            released_by_callback = not self.wait_for_sessions
+            return res
+        finally:
+            if not released_by_callback:
+                self.release_outputs()
 
     def run_sessions_parallel(self):
 
@@ -116,6 +384,172 @@ class MultiSessionPipeline(object):
         group_async_res = group(celery_tasks).apply_async()
         for (is_done, children_states_summary) in celery_utils.get_status_for_group_of_tasks(group_async_res):
             self.update_state(children_states_summary)
+            for index, async_res in enumerate(group_async_res.results):
+                if index not in self._finished_sessions and async_res.successful():
+                    self.session_finished(index, async_res.result)
             if is_done:
-                return self.run_after_sessions(group_async_res.results)
-            time.sleep(2)
\ No newline at end of file
+                return self.finish_sessions([r.result for r in group_async_res.results])
+            time.sleep(2)
+
+    def run_sessions_with_callback(self, link=None, link_error=None):
+        """ Submits the sessions and the post processing as a chord callback, without waiting.
+        on_session_finished is then called for all the sessions in the callback """
+        report_task_id = uuid()
+        self.meta["report_task_id"] = report_task_id
+        descriptor = self.callback_descriptor()
+        callback = run_after_sessions_celery.s(descriptor=descriptor).set(task_id=report_task_id)
+        callback.link_error(release_outputs_celery.si(descriptor=descriptor, report_failed=True))
+        if link is not None:
+            callback.link(link)
+        if link_error is not None:
+            callback.link_error(link_error)
+        self.update_state("Sessions submitted, the report will be created when they finish")
+        return chord(self.get_each_single_session_pipeline_as_celery_task())(callback)
+
+
+def _pipeline_from_callback_descriptor(descriptor, celery_task):
+    multi_session_pipeline = multi_session_pipeline_from_descriptor(descriptor)
+    multi_session_pipeline.celery_parent_task = celery_task
+    multi_session_pipeline.executor = None
+    return multi_session_pipeline
+
+
+@celeryapp.task(bind=True)
+def run_after_sessions_celery(self, session_results, descriptor=None):
+    multi_session_pipeline = _pipeline_from_callback_descriptor(descriptor, self)
+    try:
+        result = multi_session_pipeline.finish_sessions(session_results)
+    finally:
+        multi_session_pipeline.release_outputs(current_worker=self.request.hostname)
+    multi_session_pipeline.mark_done(result)
+    return result
+
+
+@celeryapp.task(bind=True)
+def release_outputs_celery(self, descriptor=None, report_failed=False):
+    multi_session_pipeline = _pipeline_from_callback_descriptor(descriptor, self)
+    if report_failed:
+        multi_session_pipeline.mark_failed()
+    multi_session_pipeline.release_outputs(current_worker=self.request.hostname)
+
+
+class SessionExecutor(object):
+    """ Runs the single session pipelines of a MultiSessionPipeline. Executors call
+    MultiSessionPipeline.session_finished as sessions finish and return the result
+    of MultiSessionPipeline.finish_sessions """
+
+    __metaclass__ = ABCMeta
+
+    # False if run_sessions returns before the sessions are done
+    waits_for_sessions = True
+
+    @abstractmethod
+    def run_sessions(self, multi_session_pipeline, link=None, link_error=None):
+        """ link and link_error are celery signatures, only used by executors that don't wait """
+        pass
+
+
+class CelerySessionExecutor(SessionExecutor):
+    """ Runs the sessions as a group of celery tasks """
+
+    def __init__(self, wait_for_sessions=True):
+        self.waits_for_sessions = wait_for_sessions
+
+    def run_sessions(self, multi_session_pipeline, link=None, link_error=None):
+        if self.waits_for_sessions:
+            return multi_session_pipeline.run_sessions_parallel()
+        return multi_session_pipeline.run_sessions_with_callback(link=link, link_error=link_error)
+
+
+def _run_session_pipeline(args):
+    index, pipeline, force = args
+    pipeline.run(force=force)
+    return index, pipeline.result_record()
+
+
+def _run_session_descriptor(args):
+    index, descriptor, force = args
+    return index, run_pipeline_descriptor(descriptor, force=force)
+
+
+def _collect_session_results(multi_session_pipeline, indexed_results, nb_sessions):
+    results = [None] * nb_sessions
+    for nb_done, (index, result) in enumerate(indexed_results, 1):
+        results[index] = result
+        multi_session_pipeline.update_state("Finished {} of {} sessions".format(nb_done, nb_sessions))
+        multi_session_pipeline.session_finished(index, result)
+    return multi_session_pipeline.finish_sessions(results)
+
+
+class InProcessSessionExecutor(SessionExecutor):
+    """ Runs the sessions one after the other in the current process, no broker needed """
+
+    def run_sessions(self, multi_session_pipeline, link=None, link_error=None):
+        pipelines = multi_session_pipeline.get_all_contained_single_session_pipelines()
+        indexed_results = (_run_session_pipeline((index, pipeline, multi_session_pipeline.force))
+                           for index, pipeline in enumerate(pipelines))
+        return _collect_session_results(multi_session_pipeline, indexed_results, len(pipelines))
+
+
+class ThreadPoolSessionExecutor(SessionExecutor):
+    """ Runs the sessions on a pool of threads of the current process. The heavy work happens
+    in the sima and MATLAB child processes, so threads are enough to use all the cores """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+
+    def run_sessions(self, multi_session_pipeline, link=None, link_error=None):
+        pipelines = multi_session_pipeline.get_all_contained_single_session_pipelines()
+        pool = ThreadPool(self.max_workers)
+        try:
+            indexed_results = pool.imap_unordered(_run_session_pipeline,
+                    [(index, pipeline, multi_session_pipeline.force) for index, pipeline in enumerate(pipelines)])
+            return _collect_session_results(multi_session_pipeline, indexed_results, len(pipelines))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _in_daemonic_process():
+    """ The prefork celery workers run the tasks in daemonic billiard processes """
+    return multiprocessing.current_process().daemon or billiard.current_process().daemon
+
+
+class ProcessPoolSessionExecutor(SessionExecutor):
+    """ Runs the sessions on a pool of local processes. The sessions are sent to
+    the processes as descriptors, like to the celery workers. It can't be used inside a
+    celery worker, whose processes are daemonic and can't have child processes """
+
+    def __init__(self, processes=None):
+        if _in_daemonic_process():
+            raise Exception("The processes session executor can't be used in a daemonic process such as a "
+                            "celery worker, use the threads or celery session executor instead")
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def run_sessions(self, multi_session_pipeline, link=None, link_error=None):
+        pipelines = multi_session_pipeline.get_all_contained_single_session_pipelines()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            indexed_results = pool.imap_unordered(_run_session_descriptor,
+                    [(index, pipeline_to_descriptor(pipeline), multi_session_pipeline.force)
+                     for index, pipeline in enumerate(pipelines)])
+            return _collect_session_results(multi_session_pipeline, indexed_results, len(pipelines))
+        finally:
+            pool.close()
+            pool.join()
+
+
+SESSION_EXECUTORS = {"celery": CelerySessionExecutor,
+                     "serial": InProcessSessionExecutor,
+                     "threads": ThreadPoolSessionExecutor,
+                     "processes": ProcessPoolSessionExecutor}
+
+
+def get_session_executor(name, wait_for_sessions=True, **kwargs):
+    """ Creates an executor by name: celery, serial, threads or processes.
+    wait_for_sessions only applies to celery, the local executors always wait """
+    if name not in SESSION_EXECUTORS:
+        raise Exception("Unknown session executor {} (known: {})".format(name, sorted(SESSION_EXECUTORS)))
+    if name == "celery":
+        kwargs["wait_for_sessions"] = wait_for_sessions
+    return SESSION_EXECUTORS[name](**kwargs)
@@ -5,19 +5,32 @@ import matplotlib.dates as mdates
 from matplotlib.patches import Rectangle
 from matplotlib.ticker import ScalarFormatter 
 import numpy as np
+import pandas as pd
 
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
 
 date_fmt = mdates.DateFormatter('%b %d')
 date_hour_fmt = mdates.DateFormatter('%b %d %H:%M')
+HISTORY_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-def heatmap_figure(x, y, w, h, style="plain"):
+HEATMAP_BINS = 50
+INVALID_POSITION = (-1, -1)
+
+
+def heatmap_figure(x, y, w, h, style="plain", hist=None):
+    """ hist: optional precomputed (heatmap, xedges, yedges), as returned by np.histogram2d """
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
     if style == "dots":
         ax.scatter(x, y)
     elif style == "heatmap":
-        heatmap, xedges, yedges = np.histogram2d(x, y, bins=50)
+        if hist is None:
+            hist = np.histogram2d(x, y, bins=HEATMAP_BINS)
+        heatmap, xedges, yedges = hist
         extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
         ax.imshow(heatmap, extent=extent)
 
@@ -29,46 +42,124 @@ def heatmap_figure(x, y, w, h, style="plain"):
     return fig
 
 
+def heatmap_arrays(heatmap_data):
+    """ Timestamps and x, y coordinates of the heatmap data as numpy arrays, invalid positions removed.
+    heatmap_data is either a mapping timestamp -> [x, y] or columnar: {"t": [...], "x": [...], "y": [...]} """
+    if set(heatmap_data) == {"t", "x", "y"}:
+        t = np.asarray(heatmap_data["t"])
+        x = np.asarray(heatmap_data["x"], dtype=float)
+        y = np.asarray(heatmap_data["y"], dtype=float)
+    else:
+        t = np.array(heatmap_data.keys())
+        positions = np.array(heatmap_data.values(), dtype=float).reshape(-1, 2)
+        x, y = positions[:, 0], positions[:, 1]
+    valid = ~((x == INVALID_POSITION[0]) & (y == INVALID_POSITION[1]))
+    return t[valid], x[valid], y[valid]
+
+
 def heatmap_figures(heatmap_dict, style="dots"):
-    heatmap_data = heatmap_dict["data"]
     pitch_width = heatmap_dict["pitchWidth"]
     pitch_height = heatmap_dict["pitchHeight"]
     halftime = heatmap_dict["secondHalfStartTime"]
-    centerx = pitch_width/2
-    centery = pitch_height/2
-    half1 = [ v for k,v in heatmap_data.iteritems() if k < halftime and v!=[-1,-1]]
-    half2 = [ v for k,v in heatmap_data.iteritems() if k >= halftime and v!=[-1,-1]]
-    x1 = [ t[0] for t in half1] 
-    y1 = [ t[1] for t in half1] 
-    x2 = [ t[0] for t in half2] 
-    y2 = [ t[1] for t in half2] 
-    x3 = [ centerx + (centerx - t[0]) for t in half2] 
-    y3 = [ centery + (centery - t[1]) for t in half2] 
-    fig1 = heatmap_figure(x1, y1, pitch_width, pitch_height, style=style)
-    fig2 = heatmap_figure(x2, y2, pitch_width, pitch_height, style=style)
-    fig3 = heatmap_figure(x3, y3, pitch_width, pitch_height, style=style) # this has the heatmap from 2nd half "unflipped"
+    centerx = pitch_width/2.
+    centery = pitch_height/2.
+    t, x, y = heatmap_arrays(heatmap_dict["data"])
+    second_half = t >= halftime
+    x1, y1 = x[~second_half], y[~second_half]
+    x2, y2 = x[second_half], y[second_half]
+    x3 = 2 * centerx - x2
+    y3 = 2 * centery - y2
+    hists = [None, None, None]
+    if style == "heatmap":
+        # one pass over both halves on the pitch grid, the mirrored half is the second half flipped
+        counts, (xedges, yedges, _) = np.histogramdd(
+            (x, y, second_half), bins=(HEATMAP_BINS, HEATMAP_BINS, 2),
+            range=((0, pitch_width), (0, pitch_height), (-0.5, 1.5)))
+        hists = [(counts[:, :, 0], xedges, yedges),
+                 (counts[:, :, 1], xedges, yedges),
+                 (counts[::-1, ::-1, 1], xedges, yedges)]
+    fig1 = heatmap_figure(x1, y1, pitch_width, pitch_height, style=style, hist=hists[0])
+    fig2 = heatmap_figure(x2, y2, pitch_width, pitch_height, style=style, hist=hists[1])
+    fig3 = heatmap_figure(x3, y3, pitch_width, pitch_height, style=style, hist=hists[2]) # this has the heatmap from 2nd half "unflipped"
     return fig1, fig2, fig3
 
-def team_session_history_figure(df, team_session_id, metric="Distance", date_col="Date", agg="median"):
+def team_session_history_figure(df, team_session_id, metric="Distance", date_col="Date", agg="median",
+                                date_format=HISTORY_DATE_FORMAT):
+    """ metric and agg can also be lists, one line is drawn per (metric, aggregation) pair.
+    The date column can hold datetimes or strings in date_format """
+    metrics = [metric] if isinstance(metric, basestring) else list(metric)
+    aggs = [agg] if isinstance(agg, basestring) else list(agg)
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
-    df = df.groupby(date_col)[metric].agg(agg).reset_index()
-    dates = map(lambda x: datetime.strptime(x,"%Y-%m-%d %H:%M:%S"), df[date_col].values)
-    if len(dates) >= 1 and (dates[0] - dates[-1]) > timedelta(days=1):
+    df = df.groupby(date_col)[metrics].agg(aggs)
+    if not isinstance(df.index, pd.DatetimeIndex):
+        # parse after grouping, there are fewer unique dates than rows
+        df.index = pd.to_datetime(df.index, format=date_format)
+        df = df.sort_index()
+    dates = df.index.to_pydatetime()
+    if len(dates) >= 1 and (dates[-1] - dates[0]) > timedelta(days=1):
         fmt = date_fmt
     else:
         fmt = date_hour_fmt
-    ax.plot(dates, df[metric].values)
-    ax.scatter(dates, df[metric].values)
-    ax.set_xticks(dates)
-    ax.set_yticklabels(ax.get_yticks()) # this fixes weird mpl behavior where it adds unwanted offsets
+    for m in metrics:
+        for a in aggs:
+            ax.plot(dates, df[(m, a)].values, marker="o", label="{} {}".format(a, m))
+    if len(metrics) * len(aggs) > 1:
+        ax.legend(loc="best")
+    ax.yaxis.set_major_formatter(ScalarFormatter(useOffset=False))
     ax.set_xlabel('date')
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.xaxis.set_major_formatter(fmt)
-    ax.set_ylabel(metric)
-    ax.set_title("Evolution of {} {}  over time for the team session {}".format(agg, metric, team_session_id))
+    ax.set_ylabel(", ".join(metrics))
+    ax.set_title("Evolution of {} {}  over time for the team session {}".format(
+        "/".join(aggs), ", ".join(metrics), team_session_id))
     for tick in ax.get_xticklabels():
             tick.set_rotation(45)
     ax.grid()
     fig.tight_layout() # so that labels don't get cut off at the bottom
     return fig
 
+
+FIGURE_KINDS = {"heatmap": heatmap_figure,
+                "heatmaps": heatmap_figures,
+                "team_session_history": team_session_history_figure}
+
+
+@contextmanager
+def closing_figure(figures):
+    """ Closes the figure, or tuple of figures, when leaving the block """
+    try:
+        yield figures
+    finally:
+        for fig in (figures if isinstance(figures, tuple) else (figures,)):
+            plt.close(fig)
+
+
+def render_figure(spec, fmt="png"):
+    """ Renders a figure spec to bytes in the given format.
+    spec: {"kind": one of FIGURE_KINDS, "kwargs": arguments of the figure function}
+    For kinds producing several figures, returns a tuple of bytes """
+    with closing_figure(FIGURE_KINDS[spec["kind"]](**spec.get("kwargs", {}))) as figures:
+        rendered = []
+        for fig in (figures if isinstance(figures, tuple) else (figures,)):
+            buf = BytesIO()
+            fig.savefig(buf, format=fmt)
+            rendered.append(buf.getvalue())
+    return tuple(rendered) if isinstance(figures, tuple) else rendered[0]
+
+
+def render_figures(specs, fmt="png", processes=None, max_concurrent=None):
+    """ Renders many figure specs (see render_figure) in a process pool, in order.
+    At most max_concurrent figures are open at once, one per worker process """
+    processes = processes or cpu_count()
+    if max_concurrent:
+        processes = min(processes, max_concurrent)
+    render = partial(render_figure, fmt=fmt)
+    if processes <= 1 or len(specs) <= 1:
+        return map(render, specs)
+    pool = Pool(processes=processes, maxtasksperchild=100)
+    try:
+        return pool.map(render, specs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
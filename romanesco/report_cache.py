@@ -0,0 +1,68 @@
+""" Cache of the generated html reports.
+
+A report is identified by the content of the notebook template, the values of the replace
+dict and the settings of the task that produced each input folder, so requesting the same
+report for outputs that are already complete returns the cached html immediately.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from tt_backend.utils import env, Files
+
+from evaluation2.tasks import canonical_json
+from evaluation2.task_catalog import load_output_settings
+
+DEFAULT_REPORT_CACHE_DIR = "/tmp/evaluation2_report_cache"
+
+
+def get_report_cache_dir():
+    return env.get_env_value("TT_EVALUATION2_REPORT_CACHE", optional=True) or DEFAULT_REPORT_CACHE_DIR
+
+
+def input_folders(replace_dict):
+    folders = []
+    for value in replace_dict.itervalues():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        folders.extend(v for v in values if isinstance(v, basestring))
+    return sorted(set(folders))
+
+
+def report_cache_key(notebook_template, replace_dict):
+    """ Returns the key of the report, or None if it can't be cached because the
+    settings of an input folder are unknown """
+    input_settings = {}
+    for folder in input_folders(replace_dict):
+        settings = load_output_settings(folder)
+        if settings is None:
+            return None
+        input_settings[folder] = settings
+    sha = hashlib.sha256()
+    with open(notebook_template, 'rb') as f:
+        sha.update(f.read())
+    sha.update(canonical_json({"replace_dict": replace_dict, "input_settings": input_settings}))
+    return sha.hexdigest()
+
+
+def get_cached_report_file(key):
+    return os.path.join(get_report_cache_dir(), key + ".html")
+
+
+def copy_cached_report(key, output_html):
+    """ Copies the cached report to output_html. Returns False if there is none """
+    cached = get_cached_report_file(key)
+    if not os.path.exists(cached):
+        return False
+    shutil.copy(cached, output_html)
+    return True
+
+
+def store_report(key, output_html):
+    cache_dir = get_report_cache_dir()
+    Files.make_dir_if_not_exists(cache_dir)
+    # copy then rename, so that a partially copied report is never used
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    shutil.copy(output_html, tmp_file)
+    os.rename(tmp_file, get_cached_report_file(key))
@@ -1,10 +1,12 @@
 
+from celery.exceptions import Ignore
 from tt_backend import email as tt_email
 from tt_backend.utils import Files, env
 from tt_api import slack
 
 
 from evaluation2 import celeryapp, celery_utils, data_discovery
+from evaluation2.pipeline2 import get_session_executor
 from evaluation2.nb_utils import  extract_session_ids_needed_from_ipynb
 from evaluation2.full_report_gen_pipeline import ReportGenerationPipeline,  ReportGenerationPipelineCommmitDiff
 
@@ -19,9 +21,40 @@ except:
     pass
 
 
+@celeryapp.task
+def notify_report_succeeded(notebook=None, task_link=None, task_url=None, email=None):
+    tt_email.send_email("Finished report generation task", task_link, email=email)
+    slack.post_to_evaluation_log("Report generation for {} succeeded: {}".format(notebook, task_url))
+
+
+@celeryapp.task
+def notify_report_failed(notebook=None, task_link=None, task_url=None, email=None):
+    tt_email.send_email("Report generation task failed", task_link, email=email)
+    slack.post_to_evaluation_log("Report generation for {} failed: {}".format(notebook, task_url))
+
+
+def run_or_submit_report_pipeline(multi_session_pipeline, notebook, task_link, task_url, email):
+    """ When the pipeline doesn't wait for its sessions, the notifications are sent by
+    the report callback instead of the parent task.
+
+    Returns:
+        bool: True if the report is created later by the report callback, which then
+        marks the parent task as done
+    """
+    notification_kwargs = dict(notebook=notebook, task_link=task_link, task_url=task_url, email=email)
+    if multi_session_pipeline.wait_for_sessions:
+        multi_session_pipeline.run()
+        notify_report_succeeded(**notification_kwargs)
+        return False
+    multi_session_pipeline.run(link=notify_report_succeeded.si(**notification_kwargs),
+                               link_error=notify_report_failed.si(**notification_kwargs))
+    return True
+
+
 @celeryapp.task(bind=True)
 def generate_report_end_to_end(self,fa_hash=None, gtsam_hash=None, notebook=None, force=False, output_file=None,
-        results_base_dir="/tmp/", email=None, calibration_dt=None):
+        results_base_dir="/tmp/", email=None, calibration_dt=None, wait_for_sessions=True,
+        session_executor="celery"):
     task_link, task_url = celery_utils.generate_task_link(generate_report_end_to_end.request.id,
                                                           "evaluation2.report_gen_run.generate_report_end_to_end")
     tt_email.send_email("Started report generation task", task_link, email=email)
@@ -33,23 +66,26 @@ def generate_report_end_to_end(self,fa_hash=None, gtsam_hash=None, notebook=None
 
     multi_session_pipeline = ReportGenerationPipeline(data, fa_hash=fa_hash, gtsam_hash=gtsam_hash,
             base_dir=results_base_dir, calibration_dt=calibration_dt,
-            celery_parent_task=self, notebook=notebook, output_file=output_file, force=force)
+            celery_parent_task=self, notebook=notebook, output_file=output_file, force=force,
+            executor=get_session_executor(session_executor, wait_for_sessions=wait_for_sessions))
     try:
-        multi_session_pipeline.run()
-        tt_email.send_email("Finished report generation task", task_link, email=email)
-        slack.post_to_evaluation_log("Report generation for {} succeeded: {}".format(notebook, task_url))
-        return output_file
+        submitted = run_or_submit_report_pipeline(multi_session_pipeline, notebook, task_link, task_url, email)
     except Exception as e:
          import traceback
          tt_email.send_email("Report generation task failed", task_link, email=email)
          slack.post_to_evaluation_log("Report generation for {} failed. Reason {} {}".format(notebook, e, traceback.format_exc()))
          raise Exception("Report generation failed with :{}".format(e))
+    if submitted:
+        # keep the state set by the pipeline, the report callback marks this task as done
+        raise Ignore()
+    return output_file
 
 @celeryapp.task(bind=True)
 def generate_commit_difference_report(self,fa_hash1=None, fa_hash2=None, gtsam_hash=None, notebook=None, force=False, output_file=None,
-        results_base_dir="/tmp/", email=None, calibration_dt=None):
-    task_link, task_url = celery_utils.generate_task_link(generate_report_end_to_end.request.id,
-                                                          "evaluation2.report_gen_run.generate_report_end_to_end")
+        results_base_dir="/tmp/", email=None, calibration_dt=None, wait_for_sessions=True,
+        session_executor="celery"):
+    task_link, task_url = celery_utils.generate_task_link(self.request.id,
+                                                          "evaluation2.report_gen_run.generate_commit_difference_report")
     tt_email.send_email("Started report generation task", task_link, email=email)
 
     Files.make_dir_if_not_exists(results_base_dir)
@@ -59,13 +95,15 @@ def generate_commit_difference_report(self,fa_hash1=None, fa_hash2=None, gtsam_h
 
     multi_session_pipeline =  ReportGenerationPipelineCommmitDiff(data, fa_hash1=fa_hash1, fa_hash2=fa_hash2, gtsam_hash=gtsam_hash,
             base_dir=results_base_dir, calibration_dt=calibration_dt,
-            celery_parent_task=self, notebook=notebook, output_file=output_file, force=force)
+            celery_parent_task=self, notebook=notebook, output_file=output_file, force=force,
+            executor=get_session_executor(session_executor, wait_for_sessions=wait_for_sessions))
     try:
-        multi_session_pipeline.run()
-        tt_email.send_email("Finished report generation task", task_link, email=email)
-        slack.post_to_evaluation_log("Report generation for {} succeeded: {}".format(notebook, task_url))
-        return output_file
+        submitted = run_or_submit_report_pipeline(multi_session_pipeline, notebook, task_link, task_url, email)
     except Exception as e:
          tt_email.send_email("Report generation task failed", task_link, email=email)
          slack.post_to_evaluation_log("Report generation for {} failed. Reason {}".format(notebook, e))
          raise Exception("Report generation failed with :{}".format(e))
+    if submitted:
+        # keep the state set by the pipeline, the report callback marks this task as done
+        raise Ignore()
+    return output_file
@@ -0,0 +1,121 @@
+""" Measuring the resources used by tasks and processes.
+
+What can be attributed to a task is measured per task: the subprocesses it starts and the cpu
+time of the MATLAB processes of the pool running its jobs. The rusage and io counters of the
+operating system are only available for the whole process (and the children it has waited
+for), so the cpu time, bytes read and written and peak memory are reported as process-wide
+figures, which include whatever else ran in the process at the same time.
+"""
+import os
+import resource
+import threading
+
+PROC_IO_FILE = "/proc/self/io"
+PROC_STAT_FILE = "/proc/{}/stat"
+
+_current = threading.local()
+
+
+def record_subprocess(count=1):
+    """ To be called where the pipeline starts subprocesses, so that they are counted in the
+    usage of the task running in this thread (see ResourceMonitor). Does nothing outside of a task """
+    monitor = getattr(_current, "monitor", None)
+    if monitor is not None:
+        monitor.subprocesses += count
+
+
+def record_pooled_cpu(user_seconds, system_seconds):
+    """ To be called with the cpu time a process that isn't waited for (a MATLAB process of the
+    pool) used for the task running in this thread. Does nothing outside of a task """
+    monitor = getattr(_current, "monitor", None)
+    if monitor is not None:
+        monitor.pooled_user_cpu_seconds += user_seconds
+        monitor.pooled_system_cpu_seconds += system_seconds
+
+
+def read_process_cpu(pid):
+    """ User and system cpu seconds used so far by the process and the children it has waited for.
+    Returns (None, None) if the process is gone or /proc is not available """
+    try:
+        with open(PROC_STAT_FILE.format(pid)) as f:
+            # the fields after the command name, which can have spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, IndexError):
+        return None, None
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    utime, stime, cutime, cstime = [int(v) for v in fields[11:15]]
+    return (utime + cutime) / ticks, (stime + cstime) / ticks
+
+
+def read_io_counters():
+    """ Bytes read from and written to storage by the process and the children it has waited for.
+    Returns (None, None) where /proc is not available """
+    try:
+        with open(PROC_IO_FILE) as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+def _snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = read_io_counters()
+    return {"user_cpu_seconds": own.ru_utime,
+            "system_cpu_seconds": own.ru_stime,
+            "children_user_cpu_seconds": children.ru_utime,
+            "children_system_cpu_seconds": children.ru_stime,
+            "process_max_rss_kb": own.ru_maxrss,
+            "process_children_max_rss_kb": children.ru_maxrss,
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes}
+
+# high-water marks since the process started, reported as they are at the end of the block,
+# the other counters as the difference
+PROCESS_PEAK_COUNTERS = set(["process_max_rss_kb", "process_children_max_rss_kb"])
+
+
+class ResourceMonitor(object):
+    """ Context manager measuring the resources used while the block runs. After the block:
+
+    usage is a dict with what the block itself used, in the thread running it: the number of
+    subprocesses it started (see record_subprocess) and the cpu seconds of the MATLAB pool
+    processes that ran its jobs (see record_pooled_cpu).
+
+    process_usage is a dict with the process-wide figures: the cpu seconds of the process and
+    of the children it waited for, and the bytes read and written, while the block ran, and the
+    peak rss (kB) of the process and of its biggest child since the process started. They include
+    the other threads of the process, for instance tasks or sessions running at the same time.
+    """
+
+    def __init__(self):
+        self.usage = None
+        self.process_usage = None
+        self.subprocesses = 0
+        self.pooled_user_cpu_seconds = 0.
+        self.pooled_system_cpu_seconds = 0.
+
+    def __enter__(self):
+        self._outer = getattr(_current, "monitor", None)
+        _current.monitor = self
+        self._start = _snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _snapshot()
+        _current.monitor = self._outer
+        if self._outer is not None:
+            self._outer.subprocesses += self.subprocesses
+            self._outer.pooled_user_cpu_seconds += self.pooled_user_cpu_seconds
+            self._outer.pooled_system_cpu_seconds += self.pooled_system_cpu_seconds
+        self.usage = {"subprocesses": self.subprocesses,
+                      "pooled_user_cpu_seconds": self.pooled_user_cpu_seconds,
+                      "pooled_system_cpu_seconds": self.pooled_system_cpu_seconds}
+        self.process_usage = {}
+        for key, value in end.iteritems():
+            if key in PROCESS_PEAK_COUNTERS or value is None or self._start[key] is None:
+                self.process_usage[key] = value
+            else:
+                self.process_usage[key] = value - self._start[key]
+        return False
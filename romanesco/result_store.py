@@ -0,0 +1,141 @@
+""" Keeps the disk usage of the task outputs under a budget, by evicting the least recently
+used outputs. The outputs, their size and last use are those of the task catalog (see
+task_catalog), in the same sqlite file. Outputs used by pipelines that are running are
+pinned and never evicted.
+
+The store is enabled by setting TT_EVALUATION2_RESULT_STORE_MAX_BYTES, which also enables
+the task catalog. The database is shared by all the worker processes of the machine, but
+not with other machines: eviction only knows the outputs recorded and the pins made on
+this machine. Where outputs are on a disk shared by several machines, enable the store on
+a single one of them, or give each machine its own base directory.
+"""
+from contextlib import closing
+import os
+import socket
+import time
+import uuid
+
+from tt_backend.utils import env
+
+from evaluation2 import local_db, task_catalog, trash
+
+# pins of pipelines that died without unpinning are ignored after that
+PIN_EXPIRY_SECONDS = 2 * 24 * 3600
+METADATA_SUFFIX = ".meta"
+
+SCHEMA = task_catalog.SCHEMA + [
+    "CREATE TABLE IF NOT EXISTS pins (owner TEXT, path TEXT, pinned_at REAL)",
+]
+
+
+def get_default_store():
+    """ Returns the store configured through the environment, or None if it is disabled """
+    max_bytes = env.get_env_value("TT_EVALUATION2_RESULT_STORE_MAX_BYTES", optional=True)
+    if not max_bytes:
+        return None
+    return ResultStore(task_catalog.get_catalog_file(), max_bytes=int(max_bytes))
+
+
+def _is_same_or_inside(path, directory):
+    return path == directory or path.startswith(directory.rstrip("/") + "/")
+
+
+class ResultStore(object):
+
+    def __init__(self, store_file, max_bytes=None):
+        # the sqlite file of the task catalog
+        self.store_file = store_file
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        return closing(local_db.connect(self.store_file, SCHEMA))
+
+    def pin(self, paths):
+        """ Protects the paths (and anything inside them) from eviction.
+
+        Returns:
+            str: the owner id to pass to unpin
+        """
+        owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO pins (owner, path, pinned_at) VALUES (?, ?, ?)",
+                             [(owner, path, now) for path in paths])
+            conn.commit()
+        return owner
+
+    def unpin(self, owner):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM pins WHERE owner=?", (owner,))
+            conn.commit()
+
+    def total_size(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM task_outputs").fetchone()[0]
+
+    def _downstream_paths(self, conn, path):
+        """ All the outputs derived (directly or not) from the given one """
+        res = set()
+        to_visit = [path]
+        while to_visit:
+            rows = conn.execute("SELECT path FROM dependencies WHERE upstream_path=?",
+                                (to_visit.pop(),)).fetchall()
+            for (downstream,) in rows:
+                if downstream not in res:
+                    res.add(downstream)
+                    to_visit.append(downstream)
+        return res
+
+    def evict(self, max_bytes=None):
+        """ Deletes the least recently used outputs until the indexed outputs fit in max_bytes.
+        Outputs derived from an evicted output are deleted along with it, since they
+        may link to its files. Pinned outputs, and outputs they were derived from, are kept.
+
+        Returns:
+            list: the paths that were deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return []
+        with self._connect() as conn:
+            # the victims are chosen and removed from the index in one write transaction,
+            # so that no pipeline can pin an output between the two
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = self._remove_victims(conn, max_bytes)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        for path in deleted:
+            for fn in [path, path + METADATA_SUFFIX]:
+                trash.remove(fn)
+        return deleted
+
+    def _remove_victims(self, conn, max_bytes):
+        """ Removes the outputs to evict from the index and returns their paths """
+        conn.execute("DELETE FROM pins WHERE pinned_at<?", (time.time() - PIN_EXPIRY_SECONDS,))
+        pinned = [row[0] for row in conn.execute("SELECT path FROM pins")]
+        entries = conn.execute("SELECT path, size FROM task_outputs ORDER BY last_access").fetchall()
+        sizes = dict(entries)
+        total = sum(sizes.itervalues())
+
+        def is_pinned(path):
+            return any(_is_same_or_inside(path, p) or _is_same_or_inside(p, path) for p in pinned)
+
+        deleted = []
+        for path, _ in entries:
+            if total <= max_bytes:
+                break
+            if path not in sizes:
+                continue # already evicted as downstream of another output
+            to_evict = [p for p in [path] + list(self._downstream_paths(conn, path)) if p in sizes]
+            if any(is_pinned(p) for p in to_evict):
+                continue
+            for p in to_evict:
+                deleted.append(p)
+                total -= sizes.pop(p)
+                conn.execute("DELETE FROM task_outputs WHERE path=?", (p,))
+                conn.execute("DELETE FROM dependencies WHERE path=? OR upstream_path=?", (p, p))
+        return deleted
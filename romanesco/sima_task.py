@@ -1,18 +1,55 @@
+import os
+
 from tt_backend import sima_converter as sc
 
 from tasks import FileOutputTask
+import file_digests
+from lookup_cache import map_concurrently
+from resource_usage import record_subprocess
 from formatting import red, green, orange
 
+# the bins are big files, read from the same disks
+MAX_CONCURRENT_DIGESTS = 4
+
+
+def resolve_input_digests(tasks):
+    """ Hashes the input bins of all the SimaConvertBin tasks given, a few at a time """
+    sima_tasks = [task for task in tasks if isinstance(task, SimaConvertBin)]
+    map_concurrently(lambda task: task.resolve_input_digest(), sima_tasks, max_concurrent=MAX_CONCURRENT_DIGESTS)
+
 
 class SimaConvertBin(FileOutputTask):
+    """ The input bin is only hashed when the settings or the output are first needed,
+    so that creating the task doesn't block on reading the bin """
 
     def __init__(self, output_dir=None, **kwargs):
         super(SimaConvertBin, self).__init__(**kwargs)
         self.output_dir = output_dir
+        self.input_digest = None
+        self.identify_input_by_content = False
 
     def set_input_file(self, input_bin):
         self.input_fn = input_bin
-        self.update_settings("input_bin", input_bin)
+        # identify an existing bin by its content, so that a bin that was uploaded again is
+        # converted again, and the same bin stored elsewhere reuses the results. A bin
+        # produced by a previous task is identified by its path
+        self.identify_input_by_content = os.path.exists(input_bin)
+        if not self.identify_input_by_content:
+            self.update_settings("input_bin", input_bin)
+
+    def resolve_input_digest(self):
+        if self.identify_input_by_content and self.input_digest is None:
+            self.input_digest = file_digests.file_digest(self.input_fn)
+            self.update_settings("input_bin_sha256", self.input_digest)
+        return self.input_digest
+
+    def settings(self):
+        self.resolve_input_digest()
+        return super(SimaConvertBin, self).settings()
+
+    def fingerprint(self):
+        self.resolve_input_digest()
+        return super(SimaConvertBin, self).fingerprint()
 
     def check_requirements(self):
         sima_conv_dir, sima_bin = sc.get_local_paths()
@@ -42,6 +79,7 @@ class SimaConvertBin(FileOutputTask):
             local = False
         input_fn = self.input_fn
         if local:
+            record_subprocess()
             sc.convert_local(input_fn, sima_conv_dir, sima_bin, target_dir=self.output(), force=True)
         else:
             sc.convert(input_fn, target_dir=self.output(), force_recompute=True)
@@ -0,0 +1,140 @@
+""" Stage outputs that reference the files of upstream stages instead of symlinking them.
+
+The directory of a stage only holds the files the stage writes, plus a manifest listing
+the upstream directories (and which of their files) it builds on. The full content of the
+stage is resolved from the manifests when it is needed, following the manifests of the
+upstream directories too. Code that needs a flat directory (the MATLAB code, the report
+notebooks) gets a temporary view made of symlinks, outside of the outputs.
+"""
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import tempfile
+
+from tt_backend.utils import env, Files
+
+MANIFEST_FN = ".stage_manifest.json"
+MANIFEST_VERSION = 1
+METADATA_SUFFIX = ".meta"
+DEFAULT_VIEWS_DIR = os.path.join(tempfile.gettempdir(), "evaluation2_staging_views")
+
+
+def get_manifest_file(stage_dir):
+    return os.path.join(stage_dir, MANIFEST_FN)
+
+
+def read_manifest(stage_dir):
+    """ Returns the sources of the stage: a list of dicts with the upstream "directory",
+    the "filenames" used from it (None for all of them) and the filenames to "skip" """
+    manifest_file = get_manifest_file(stage_dir)
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise Exception("Unsupported stage manifest version {} in {}".format(manifest.get("version"), manifest_file))
+    return manifest["sources"]
+
+
+def add_source(stage_dir, directory, filenames=None, filenames_to_skip=()):
+    """ Records that the stage uses the given files (or all files) of directory, replacing
+    what was recorded before for the same directory, so that rerunning a task doesn't add it twice.
+    Files that don't exist in directory when the stage is resolved are skipped """
+    source = {"directory": os.path.abspath(directory),
+              "filenames": list(filenames) if filenames is not None else None,
+              "skip": sorted(filenames_to_skip)}
+    sources = read_manifest(stage_dir)
+    if source in sources:
+        return
+    same_directory = [i for i, s in enumerate(sources) if s["directory"] == source["directory"]]
+    if same_directory:
+        sources = [s for s in sources if s["directory"] != source["directory"]]
+        sources.insert(same_directory[0], source)
+    else:
+        sources.append(source)
+    Files.make_dir_if_not_exists(stage_dir)
+    # written to a temporary file and renamed, so that readers never see a partial manifest
+    fd, tmp_file = tempfile.mkstemp(dir=stage_dir, suffix=".tmp")
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "sources": sources}, f, indent=2)
+    os.rename(tmp_file, get_manifest_file(stage_dir))
+
+
+def _own_files(stage_dir):
+    if not os.path.isdir(stage_dir):
+        return {}
+    return dict((fn, os.path.join(stage_dir, fn)) for fn in os.listdir(stage_dir)
+                if fn != MANIFEST_FN)
+
+
+def resolve(stage_dir, _visiting=None):
+    """ Returns a dict filename -> path of the actual file, for the files written by the
+    stage and the files it uses from upstream. The stage's own files take precedence """
+    visiting = set() if _visiting is None else _visiting
+    stage_dir = os.path.abspath(stage_dir)
+    if stage_dir in visiting:
+        raise Exception("Circular stage manifests at {}".format(stage_dir))
+    visiting.add(stage_dir)
+    res = {}
+    for source in read_manifest(stage_dir):
+        upstream = resolve(source["directory"], visiting)
+        names = upstream.keys() if source["filenames"] is None else source["filenames"]
+        for fn in names:
+            if fn in upstream and fn not in source["skip"] and fn not in res:
+                res[fn] = upstream[fn]
+    visiting.discard(stage_dir)
+    res.update(_own_files(stage_dir))
+    return res
+
+
+def get_views_dir():
+    return env.get_env_value("TT_EVALUATION2_STAGING_VIEWS", optional=True) or DEFAULT_VIEWS_DIR
+
+
+def materialize(stage_dir, view_dir):
+    """ Symlinks the resolved files of the stage into view_dir, so that it looks like a
+    directory holding all the files. The settings file next to the stage is linked next to
+    the view as well """
+    Files.make_dir_if_not_exists(view_dir)
+    for fn, path in resolve(stage_dir).iteritems():
+        os.symlink(path, os.path.join(view_dir, fn))
+    metadata_file = stage_dir.rstrip("/") + METADATA_SUFFIX
+    if os.path.exists(metadata_file):
+        os.symlink(metadata_file, view_dir.rstrip("/") + METADATA_SUFFIX)
+    return view_dir
+
+
+def _remove_view(view_dir):
+    shutil.rmtree(view_dir)
+    if os.path.lexists(view_dir + METADATA_SUFFIX):
+        os.remove(view_dir + METADATA_SUFFIX)
+
+
+@contextmanager
+def temporary_views(stage_dirs):
+    """ Yields a dict stage directory -> flat directory with all its files, for the stage
+    directories that have a manifest. The views are made in a scratch directory
+    (TT_EVALUATION2_STAGING_VIEWS), never inside the outputs, and removed afterwards """
+    views = {}
+    try:
+        for stage_dir in stage_dirs:
+            if stage_dir in views or not os.path.exists(get_manifest_file(stage_dir)):
+                continue
+            views_dir = get_views_dir()
+            Files.make_dir_if_not_exists(views_dir)
+            view_dir = tempfile.mkdtemp(prefix=os.path.basename(stage_dir.rstrip("/")) + "_", dir=views_dir)
+            views[stage_dir] = view_dir
+            materialize(stage_dir, view_dir)
+        yield views
+    finally:
+        for view_dir in views.itervalues():
+            _remove_view(view_dir)
+
+
+@contextmanager
+def temporary_view(stage_dir):
+    """ Yields a flat directory with all the files of the stage (the stage directory itself
+    if it has no manifest) """
+    with temporary_views([stage_dir]) as views:
+        yield views.get(stage_dir, stage_dir)
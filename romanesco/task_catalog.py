@@ -0,0 +1,150 @@
+""" Local catalog of the completed task outputs, keyed on output path.
+
+Checking whether a task is complete is a single indexed query (and a stat of the output)
+instead of reading and parsing the .meta file next to every output, and the completeness
+of all the tasks of a pipeline can be queried at once. An output is complete if it was
+recorded with the fingerprint of the task. Fingerprints don't include the output directory,
+so the same fingerprint can be recorded for several paths. The catalog is the index of the
+outputs: besides the settings it keeps their size (measured once, when the task completes),
+their last use and the outputs they were derived from, which the result store uses to
+evict outputs (see result_store).
+
+The catalog is enabled by setting TT_EVALUATION2_TASK_CATALOG to the path of the sqlite
+file. It is also enabled by the result store, in TT_EVALUATION2_RESULT_STORE (default
+/tmp/evaluation2_result_store.sqlite) unless TT_EVALUATION2_TASK_CATALOG is set.
+The .meta files are still written as an export for the reports and other tools,
+unless TT_EVALUATION2_EXPORT_META_FILES is set to 0. Outputs completed before the catalog
+was enabled are added to it the first time their .meta file is found to match.
+"""
+from contextlib import closing
+import json
+import os
+import time
+
+from tt_backend.utils import env
+
+from evaluation2 import local_db
+
+DEFAULT_STORE_FILE = "/tmp/evaluation2_result_store.sqlite"
+METADATA_SUFFIX = ".meta"
+# sqlite limits the number of parameters of a query
+MAX_QUERY_PARAMETERS = 500
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS task_outputs (
+       path TEXT PRIMARY KEY, fingerprint TEXT, settings TEXT, completed_at REAL, size INTEGER, last_access REAL)""",
+    "CREATE INDEX IF NOT EXISTS task_outputs_last_access ON task_outputs (last_access)",
+    """CREATE TABLE IF NOT EXISTS dependencies (
+       path TEXT, upstream_path TEXT, PRIMARY KEY (path, upstream_path))""",
+    "CREATE INDEX IF NOT EXISTS dependencies_upstream ON dependencies (upstream_path)",
+]
+
+
+def get_catalog_file():
+    """ The sqlite file of the catalog, or None if it is disabled """
+    catalog_file = env.get_env_value("TT_EVALUATION2_TASK_CATALOG", optional=True)
+    if catalog_file:
+        return catalog_file
+    if env.get_env_value("TT_EVALUATION2_RESULT_STORE_MAX_BYTES", optional=True):
+        return env.get_env_value("TT_EVALUATION2_RESULT_STORE", optional=True) or DEFAULT_STORE_FILE
+    return None
+
+
+def get_default_catalog():
+    """ Returns the catalog configured through the environment, or None if it is disabled """
+    catalog_file = get_catalog_file()
+    if catalog_file is None:
+        return None
+    return TaskCatalog(catalog_file)
+
+
+def export_meta_files():
+    """ Whether the .meta files are written next to the outputs """
+    if get_default_catalog() is None:
+        return True
+    return env.get_env_value("TT_EVALUATION2_EXPORT_META_FILES", optional=True) != "0"
+
+
+def get_output_size(path):
+    """ Bytes used by a file or directory. Symlinks are not followed """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size if os.path.lexists(path) else 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fn in dirs + files:
+            size += os.lstat(os.path.join(root, fn)).st_size
+    return size
+
+
+def load_output_settings(output):
+    """ The settings of the task that produced the output, from the catalog or else
+    from the .meta file. Returns None if they are unknown """
+    catalog = get_default_catalog()
+    if catalog is not None:
+        settings = catalog.settings_of(output)
+        if settings is not None:
+            return settings
+    metadata_file = output + METADATA_SUFFIX
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file) as f:
+        return json.load(f)
+
+
+class TaskCatalog(object):
+
+    def __init__(self, catalog_file):
+        self.catalog_file = catalog_file
+
+    def _connect(self):
+        return closing(local_db.connect(self.catalog_file, SCHEMA))
+
+    def touch(self, task):
+        """ Marks the recorded output of the task as used.
+        Returns False if the output of the task isn't recorded """
+        with self._connect() as conn:
+            updated = conn.execute("UPDATE task_outputs SET last_access=? WHERE path=? AND fingerprint=?",
+                                   (time.time(), task.output(), task.fingerprint())).rowcount
+            conn.commit()
+        return updated > 0
+
+    def record(self, task):
+        """ Records the output of the task as complete, with its size and the outputs it was
+        derived from. Any other entry for the same output is replaced """
+        path = task.output()
+        size = get_output_size(path) + get_output_size(path + METADATA_SUFFIX)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO task_outputs "
+                         "(path, fingerprint, settings, completed_at, size, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                         (path, task.fingerprint(), json.dumps(task.settings()), now, size, now))
+            conn.execute("DELETE FROM dependencies WHERE path=?", (path,))
+            conn.executemany("INSERT OR IGNORE INTO dependencies (path, upstream_path) VALUES (?, ?)",
+                             [(path, prev.output()) for prev in task.prev_tasks()])
+            conn.commit()
+
+    def forget(self, task):
+        """ Removes the output of the task from the catalog, for instance before it is rewritten """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM task_outputs WHERE path=?", (task.output(),))
+            conn.commit()
+
+    def complete_tasks(self, tasks):
+        """ Returns the subset of the tasks that are recorded as complete and whose output still exists """
+        paths = list(set(task.output() for task in tasks))
+        recorded = {}
+        with self._connect() as conn:
+            for i in range(0, len(paths), MAX_QUERY_PARAMETERS):
+                chunk = paths[i:i + MAX_QUERY_PARAMETERS]
+                recorded.update(conn.execute("SELECT path, fingerprint FROM task_outputs WHERE path IN ({})".format(
+                    ",".join("?" * len(chunk))), chunk).fetchall())
+        return set(task for task in tasks
+                   if recorded.get(task.output()) == task.fingerprint() and os.path.exists(task.output()))
+
+    def is_complete(self, task):
+        return task in self.complete_tasks([task])
+
+    def settings_of(self, output):
+        with self._connect() as conn:
+            row = conn.execute("SELECT settings FROM task_outputs WHERE path=?", (output,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
@@ -1,11 +1,13 @@
 import os
 
 from abc import ABCMeta, abstractmethod
+import hashlib
 import json
 
-import shutil
+import weakref
 
 from evaluation2.formatting import green, blue
+from evaluation2 import task_catalog, trash
 
 
 def write_metadata_at_end(func):
@@ -19,9 +21,25 @@ def write_metadata_at_end(func):
     return wrapper_func
 
 
+def canonical_json(obj):
+    """ Serializes obj the same way in every process, so that it can be hashed """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def output_of(path_or_task):
+    """ Paths given to a task can be the task producing them instead, so that
+    they're only resolved when the task needs them """
+    if isinstance(path_or_task, Task):
+        return path_or_task.output()
+    return path_or_task
+
+
 class Task:
     __metaclass__ = ABCMeta
 
+    # Number of hex characters of the fingerprint used in output paths
+    CHECKSUM_LENGTH = 32
+
     def __init__(self, force=False, output_type="plain", prev_tasks=None, **kwargs):
     
         self._force = force
@@ -31,18 +49,48 @@ class Task:
         else:
             self._prev_tasks = prev_tasks
         self._settings = kwargs
+        self._settings_cache = None
+        self._fingerprint_cache = None
+        # tasks that have cached settings computed from this task's settings
+        self._next_tasks = weakref.WeakSet()
+
+    def __getstate__(self):
+        # weak references can't be pickled. The downstream links get registered again
+        # when the settings are next computed
+        state = self.__dict__.copy()
+        del state["_next_tasks"]
+        state["_settings_cache"] = None
+        state["_fingerprint_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._next_tasks = weakref.WeakSet()
 
     @abstractmethod
     def name(self):
         pass
 
+    def fingerprint(self):
+        """ SHA-256 digest of the task name, its own settings and the fingerprints of the
+        upstream tasks. It doesn't depend on the process or machine computing it, so
+        every worker derives the same outputs for the same task """
+        if self._fingerprint_cache is None:
+            upstream = sorted(task.fingerprint() for task in self.prev_tasks())
+            for task in self.prev_tasks():
+                task._next_tasks.add(self)
+            self._fingerprint_cache = hashlib.sha256(canonical_json(
+                {"name": self.name(), "settings": self._settings, "upstream": upstream})).hexdigest()
+        return self._fingerprint_cache
+
     def checksum(self):
-        csum = reduce(lambda x,y : x^y, [hash(item) for item in self.settings().items()])
-        return str(abs(csum))
+        """ Shortened fingerprint to be used in output paths """
+        return self.fingerprint()[:self.CHECKSUM_LENGTH]
 
     def add_previous_task(self, task):
         # sets a direct dependency
         self._prev_tasks.append(task)
+        self.invalidate_settings()
 
     def set_force(self, force):
         self._force = force
@@ -54,17 +102,35 @@ class Task:
         return self._prev_tasks
 
     def settings(self):
-        """ Get all the settings that uniquely define the task """
-        settings = self._settings 
-        dependent_settings = self.get_dependent_settings()
-        for k,v in settings.iteritems():
-            if k in dependent_settings and dependent_settings[k]!=v:
-                raise Exception("Inconsistent settings: Trying to set value for {} to {} (already = {})".format(k, v, dependent_settings[k]))
-            dependent_settings[k] = v
-        return dependent_settings 
+        """ Get all the settings that uniquely define the task. They are computed once
+        and cached until the settings of this task or of an upstream task change """
+        if self._settings_cache is None:
+            settings = self._settings
+            dependent_settings = self.get_dependent_settings()
+            for k,v in settings.iteritems():
+                if k in dependent_settings and dependent_settings[k]!=v:
+                    raise Exception("Inconsistent settings: Trying to set value for {} to {} (already = {})".format(k, v, dependent_settings[k]))
+                dependent_settings[k] = v
+            for task in self.prev_tasks():
+                task._next_tasks.add(self)
+            self._settings_cache = dependent_settings
+        return dict(self._settings_cache)
 
     def update_settings(self, k, v):
+        if k in self._settings and self._settings[k] == v:
+            return
         self._settings[k] = v
+        self.invalidate_settings()
+
+    def invalidate_settings(self):
+        """ Drop the cached settings and fingerprint of this task and of all the tasks depending on it """
+        if self._settings_cache is None and self._fingerprint_cache is None:
+            # downstream tasks can only have cached values if this task has
+            return
+        self._settings_cache = None
+        self._fingerprint_cache = None
+        for task in list(self._next_tasks):
+            task.invalidate_settings()
 
     def check_requirements(self):
         """ Override this to check requirements before running the pipeline """
@@ -100,8 +166,10 @@ class Task:
         pass
 
     @write_metadata_at_end
-    def run(self, force_defined_externally=False):
-        if not self.force() and not force_defined_externally and self.is_already_complete():
+    def run(self, force_defined_externally=False, known_complete=False):
+        """ known_complete: the task is already known to be complete (for instance from a query
+        of the task catalog for the whole pipeline), so it isn't checked again """
+        if not self.force() and not force_defined_externally and (known_complete or self.is_already_complete()):
             print "Task {} (settings : {}) : {} at {}".format(green(self.name()), self.settings(), blue("Already complete"), self.output())
             return self.output()
         elif self.force():
@@ -122,21 +190,34 @@ class FileOutputTask(Task):
         return self.output() + self.METADATA_SUFFIX
 
     def write_metadata(self):
-        with open(self.get_metadata_file(), 'w') as outf:
-            json.dump(self.settings(), outf)
+        catalog = task_catalog.get_default_catalog()
+        if catalog is not None and catalog.touch(self):
+            # already complete, it only needs to be marked as used
+            return
+        if task_catalog.export_meta_files():
+            with open(self.get_metadata_file(), 'w') as outf:
+                json.dump(self.settings(), outf)
+        if catalog is not None:
+            catalog.record(self)
 
     def clean(self):
-        out = self.output()
-        if os.path.isdir(out):
-            shutil.rmtree(out)
-        elif os.path.exists(out):
-            os.remove(out)
+        catalog = task_catalog.get_default_catalog()
+        if catalog is not None:
+            catalog.forget(self)
+        # large outputs are moved to the trash and deleted in the background
+        trash.remove(self.output())
 
     def is_already_complete(self):
+        catalog = task_catalog.get_default_catalog()
+        if catalog is not None and catalog.is_complete(self):
+            return True
         output_exists = os.path.exists(self.output())
         if not output_exists:
             return False
         metadata_file = self.get_metadata_file()
+        if not os.path.exists(metadata_file) and catalog is not None:
+            # not in the catalog and no metadata exported: only cleaned if the task runs
+            return False
         if not os.path.exists(metadata_file):
            # raise Exception("Task "+self.name()+" didn't write metadata. It's possible it's already existing output" +
            # " {} is incomplete. Either manually remove the output or specify force=True to clean and rerun everything".format(self.output()))
@@ -150,6 +231,9 @@ class FileOutputTask(Task):
             raise Exception("Task {} didn't write metadata properly at {} (exception when reading json_str {} : {}). It's possible it's already existing output {} is incomplete. Either manually remove the output or specify force=True to clean and rerun everything".format(self.name(), metadata_file,
                 json_str, e, self.output()))
         is_complete = settings_that_have_been_saved  == self.settings()
+        if is_complete and catalog is not None:
+            # output from before the catalog was enabled
+            catalog.record(self)
         if not is_complete:
             print "Saved settings {} do not match specified {} so task needs to rerun".format(settings_that_have_been_saved, self.settings())
         return is_complete
@@ -0,0 +1,230 @@
+""" Deleting outputs without waiting for it.
+
+The output is renamed into a trash directory on the same volume, which returns at once,
+and a background reaper thread deletes the content of the trash with the lowest cpu and
+I/O priority. The trash directories are kept in a registry (TT_EVALUATION2_TRASH_REGISTRY,
+default /tmp/evaluation2_trash.sqlite), so that whatever is left in them when a process
+exits is deleted by the next reaper, which is also started when a celery worker starts.
+A reaper first claims the entries it deletes by renaming them into a directory of its own
+process, so that several processes never delete the same entries. Entries that can't be
+deleted are retried less and less often.
+
+TT_EVALUATION2_TRASH_DIR sets a trash directory to use first, for the paths on its volume.
+Setting TT_EVALUATION2_TRASH to 0 deletes outputs synchronously instead.
+"""
+from contextlib import closing
+from distutils.spawn import find_executable
+import errno
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+from celery.signals import worker_ready
+from tt_backend.utils import env, Files
+
+from evaluation2 import local_db
+
+TRASH_DIR_NAME = ".evaluation2_trash"
+DEFAULT_REGISTRY_FILE = "/tmp/evaluation2_trash.sqlite"
+CLAIM_PREFIX = ".reaping_"
+# claims of processes of other machines are taken over after that, their process is assumed dead
+ABANDONED_CLAIM_SECONDS = 24 * 3600
+FIRST_RETRY_SECONDS = 60
+MAX_RETRY_SECONDS = 3600
+
+REGISTRY_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS trash_dirs (path TEXT PRIMARY KEY)",
+]
+
+_reaper_lock = threading.Lock()
+_reaper_thread = None
+_reaper_wakeup = threading.Event()
+
+
+def _registry():
+    registry_file = env.get_env_value("TT_EVALUATION2_TRASH_REGISTRY", optional=True) or DEFAULT_REGISTRY_FILE
+    return closing(local_db.connect(registry_file, REGISTRY_SCHEMA))
+
+
+def trash_enabled():
+    return env.get_env_value("TT_EVALUATION2_TRASH", optional=True) != "0"
+
+
+def mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def trash_dir_candidates(path):
+    """ Trash directories that may be on the volume of path: the configured one, at the mount
+    point if it is writable, otherwise next to the path """
+    parent = os.path.dirname(os.path.abspath(path))
+    mount = mount_point(parent)
+    candidates = [os.path.join(parent, TRASH_DIR_NAME)]
+    if os.access(mount, os.W_OK):
+        candidates.insert(0, os.path.join(mount, TRASH_DIR_NAME))
+    configured = env.get_env_value("TT_EVALUATION2_TRASH_DIR", optional=True)
+    if configured:
+        candidates.insert(0, configured)
+    return candidates
+
+
+def delete_now(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def move_to_trash(path):
+    """ Renames path into a trash directory of its volume. Returns the trash directory,
+    or None if no trash directory can take it """
+    name = "{}_{}".format(os.path.basename(path.rstrip("/")), uuid.uuid4().hex)
+    for trash_dir in trash_dir_candidates(path):
+        try:
+            Files.make_dir_if_not_exists(trash_dir)
+            os.rename(path, os.path.join(trash_dir, name))
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EACCES, errno.EPERM, errno.EROFS):
+                continue # on another volume or not writable
+            raise
+        with _registry() as conn:
+            conn.execute("INSERT OR IGNORE INTO trash_dirs (path) VALUES (?)", (trash_dir,))
+            conn.commit()
+        return trash_dir
+    return None
+
+
+def remove(path):
+    """ Removes the file or directory at path. Directories are moved to the trash and
+    deleted in the background, unless the trash is disabled or not usable """
+    if os.path.islink(path) or not os.path.isdir(path) or not trash_enabled():
+        delete_now(path)
+        return
+    if move_to_trash(path) is None:
+        delete_now(path)
+        return
+    start_reaper()
+
+
+def _delete_low_priority(path):
+    """ Returns True if path was deleted """
+    command = ["rm", "-rf", path]
+    if find_executable("ionice"):
+        command = ["ionice", "-c", "3"] + command # idle I/O class: only uses the disk when nobody else does
+    subprocess.call(["nice", "-n", "19"] + command)
+    return not os.path.lexists(path)
+
+
+def _claim_dir(trash_dir):
+    return os.path.join(trash_dir, "{}{}_{}".format(CLAIM_PREFIX, socket.gethostname(), os.getpid()))
+
+
+def _is_abandoned_claim(path):
+    """ Whether the claim directory belongs to a process that is gone """
+    host, _, pid = os.path.basename(path)[len(CLAIM_PREFIX):].rpartition("_")
+    if host != socket.gethostname() or not pid.isdigit():
+        return time.time() - os.lstat(path).st_mtime > ABANDONED_CLAIM_SECONDS
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def _claim_entries(trash_dir):
+    """ Renames the entries of the trash directory into the claim directory of this process,
+    so that no other process deletes them at the same time. Returns the paths of the entries
+    claimed, now or before, that are still to delete """
+    claim_dir = _claim_dir(trash_dir)
+    Files.make_dir_if_not_exists(claim_dir)
+    for name in os.listdir(trash_dir):
+        path = os.path.join(trash_dir, name)
+        if path == claim_dir or (name.startswith(CLAIM_PREFIX) and not _is_abandoned_claim(path)):
+            continue
+        try:
+            os.rename(path, os.path.join(claim_dir, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # claimed by another process
+    return [os.path.join(claim_dir, name) for name in os.listdir(claim_dir)]
+
+
+def reap():
+    """ Deletes the content of all the registered trash directories that no other process is deleting.
+    Returns the number of entries deleted and the number of entries that couldn't be deleted """
+    with _registry() as conn:
+        trash_dirs = [row[0] for row in conn.execute("SELECT path FROM trash_dirs")]
+    deleted = failed = 0
+    for trash_dir in trash_dirs:
+        if not os.path.isdir(trash_dir):
+            with _registry() as conn:
+                conn.execute("DELETE FROM trash_dirs WHERE path=?", (trash_dir,))
+                conn.commit()
+            continue
+        for path in _claim_entries(trash_dir):
+            if _delete_low_priority(path):
+                deleted += 1
+            else:
+                failed += 1
+        try:
+            os.rmdir(_claim_dir(trash_dir))
+        except OSError:
+            pass # entries left to delete
+    return deleted, failed
+
+
+def _reaper_loop():
+    global _reaper_thread
+    retry_seconds = FIRST_RETRY_SECONDS
+    while True:
+        _reaper_wakeup.clear()
+        try:
+            deleted, failed = reap()
+        except Exception as e:
+            print "Emptying the trash failed: {}".format(e)
+            deleted, failed = 0, 1
+        if deleted:
+            retry_seconds = FIRST_RETRY_SECONDS
+        elif failed:
+            # entries that can't be deleted for now (busy, open on a network disk): retry later
+            _reaper_wakeup.wait(retry_seconds)
+            retry_seconds = min(2 * retry_seconds, MAX_RETRY_SECONDS)
+            continue
+        with _reaper_lock:
+            # decided under the lock, so that nothing moved to the trash meanwhile is left behind
+            if not deleted and not _reaper_wakeup.is_set():
+                _reaper_thread = None
+                return
+
+
+def wait_for_reaper(timeout=None):
+    """ Waits until the background thread emptying the trash is done, if it is running """
+    thread = _reaper_thread
+    if thread is not None:
+        thread.join(timeout)
+
+
+def start_reaper():
+    """ Starts the background thread emptying the trash, if it isn't running already """
+    global _reaper_thread
+    with _reaper_lock:
+        _reaper_wakeup.set()
+        if _reaper_thread is not None and _reaper_thread.is_alive(): # not alive in forked processes
+            return
+        _reaper_thread = threading.Thread(target=_reaper_loop, name="evaluation2-trash-reaper")
+        _reaper_thread.daemon = True
+        _reaper_thread.start()
+
+
+@worker_ready.connect
+def reap_on_worker_start(**kwargs):
+    """ Deletes what previous worker processes left in the trash """
+    start_reaper()